@@ -7,7 +7,11 @@ import skimage.color
 from utils.cylical_learning_rate import CyclicLR
 from utils._auc import AUC
 
-def get_callbacks(model=None):
+def get_callbacks(model=None, is_chief=True):
+    """
+    :param is_chief: False for the other workers of a multi-worker training, they keep the learning rate schedule but
+        do not write checkpoints and logs
+    """
     clr = CyclicLR(base_lr=CLR_BASELR, max_lr=CLR_MAXLR,
                    step_size=CLR_PATIENCE * ceil(TRAIN_N / BATCH_SIZE), mode='triangular')
     model_ckp = tf.keras.callbacks.ModelCheckpoint(MODELCKP_PATH,
@@ -31,7 +35,7 @@ def get_callbacks(model=None):
     # Define the per-epoch callback.
     lrate = tf.keras.callbacks.LearningRateScheduler(step_decay)
 
-    _callbacks = [clr if USE_CLR else lrate, tensorboard_cbk, model_ckp]  # callbacks list
+    _callbacks = [clr if USE_CLR else lrate, tensorboard_cbk, model_ckp] if is_chief else [clr if USE_CLR else lrate]  # callbacks list
     # _callbacks = [tensorboard_cbk, model_ckp, early_stopping]  # callbacks list
 
     if USE_EARLY_STOPPING:
@@ -27,7 +27,7 @@ if __name__ == "__main__":
 
     _losses = []
 
-    # _XEloss = get_weighted_loss(CHEXPERT_CLASS_WEIGHT)
+    # _XEloss = get_weighted_loss(CLASS_WEIGHT)
     _XEloss = tf.keras.losses.BinaryCrossentropy(from_logits=False)
     _losses.append(_XEloss)
 
@@ -60,7 +60,9 @@ if __name__ == "__main__":
     # define image logging
     def log_gradcampp(epoch, logs):
         _image = read_image_and_preprocess(SAMPLE_FILENAME, use_sn=True)
-        image_ori = skimage.color.gray2rgb(read_image_and_preprocess(SAMPLE_FILENAME, use_sn=False))
+        # the display image is 0~1 even if the model input is uint8 (USE_IN_MODEL_PREPROCESS)
+        image_ori = skimage.color.gray2rgb(read_image_and_preprocess(SAMPLE_FILENAME, use_sn=False, use_preprocess_img=False,
+                                                                     in_model_preprocess=False))
 
         image = np.reshape(_image, (-1, IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE, 1))
 
@@ -1,13 +1,18 @@
 """
 Train normal model with binary XE as loss function
 """
+import tempfile
 from tensorflow.python.keras.callbacks import configure_callbacks
 from tqdm import tqdm
 
 from _callbacks import get_callbacks
-from datasets.cheXpert_dataset import read_dataset
+from datasets.cheXpert_dataset import read_dataset, read_dual_domain_dataset, estimate_echo_factor
+from datasets.data_service import get_data_service_address
+from utils.utils import get_optimizer, get_scaled_loss, get_unscaled_gradients, get_strategy, is_chief_worker, \
+    get_worker_cache_dir
 from models.discriminator import make_discriminator_model
 from utils._auc import AUC
+from utils.xla import compile_step, count_retrace, get_batch_signature, get_num_retraces
 from utils.visualization import *
 from models.gan import *
 
@@ -16,45 +21,63 @@ TARGET_DATASET_FILENAME = CHESTXRAY_TRAIN_TARGET_TFRECORD_PATH
 TARGET_DATASET_PATH = CHESTXRAY_DATASET_PATH
 
 if __name__ == "__main__":
-    model = GANModel()
-    discriminator = make_discriminator_model()
-
-    # to initiate the graph
-    model.call_w_features(tf.zeros((1, IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE, 1)))
-
-    # get the dataset
-    train_dataset = read_dataset(TRAIN_TARGET_TFRECORD_PATH, DATASET_PATH,
-                                 use_augmentation=USE_AUGMENTATION,
-                                 use_patient_data=USE_PATIENT_DATA,
-                                 use_feature_loss=False,
-                                 use_preprocess_img=True)
+    # data parallel over the workers of TF_CONFIG (see multi_worker_launcher.py), a single replica without it
+    strategy = get_strategy()
+    _is_chief = is_chief_worker()
+
+    with strategy.scope():  # the variables are mirrored on every replica
+        model = GANModel()
+        discriminator = make_discriminator_model()
+
+        # to initiate the graph
+        model.call_w_features(tf.zeros((1, IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE, 1)))
+
+    # get the dataset, source and target batches come from a single pipeline (no target batches without the GAN)
+    # every worker reads its own shard of the records, the global batch BATCH_SIZE is split over the replicas
+    def get_train_dataset(echo_factor=1):
+        def _dataset_fn(input_context):
+            dataset = read_dual_domain_dataset(TRAIN_TARGET_TFRECORD_PATH, DATASET_PATH,
+                                               TARGET_DATASET_FILENAME, TARGET_DATASET_PATH,
+                                               target_ratio=DUAL_DOMAIN_TARGET_RATIO if USE_GAN else 0.,
+                                               use_augmentation=USE_AUGMENTATION,
+                                               use_preprocess_img=True,
+                                               repeat=input_context.num_input_pipelines > 1,
+                                               echo_factor=echo_factor,
+                                               data_service_address=get_data_service_address(),
+                                               batch_size=input_context.get_per_replica_batch_size(BATCH_SIZE),
+                                               num_shards=input_context.num_input_pipelines,
+                                               shard_index=input_context.input_pipeline_id)
+            # the same amount of batches on every worker, a step waits for the gradients of all of them
+            return dataset.take(TRAIN_N // BATCH_SIZE * echo_factor) if input_context.num_input_pipelines > 1 else dataset
+
+        return strategy.distribute_datasets_from_function(_dataset_fn)
 
     val_dataset = read_dataset(VALID_TARGET_TFRECORD_PATH, DATASET_PATH,
                                use_patient_data=USE_PATIENT_DATA,
                                use_feature_loss=False,
-                               use_preprocess_img=True)
+                               use_preprocess_img=True,
+                               cache_dir=get_worker_cache_dir(DATASET_CACHE_DIR))  # validated every epoch, decoded only once
     test_dataset = read_dataset(TEST_TARGET_TFRECORD_PATH, DATASET_PATH,
                                 use_patient_data=USE_PATIENT_DATA,
                                 use_feature_loss=False,
                                 use_preprocess_img=True)
 
-    train_target_dataset = read_dataset(TARGET_DATASET_FILENAME, TARGET_DATASET_PATH,
-                                        use_augmentation=False,
-                                        use_patient_data=USE_PATIENT_DATA,
-                                        use_feature_loss=False,
-                                        use_preprocess_img=True,
-                                        repeat=True)
-
     # losses, optimizer, metrics
     _XEloss = tf.keras.losses.BinaryCrossentropy(from_logits=False, reduction=tf.keras.losses.Reduction.AUTO)
+    # the train steps reduce per replica, the AUTO reduction is not allowed in strategy.run
+    _XEloss_per_sample = tf.keras.losses.BinaryCrossentropy(from_logits=False, reduction=tf.keras.losses.Reduction.NONE)
 
-    # optimizer
-    _optimizer = tf.keras.optimizers.Adam(LEARNING_RATE, amsgrad=True)
-    _optimizer_disc = tf.keras.optimizers.Adam(DISC_LEARNING_RATE, amsgrad=True)
+    def _xe_loss(y_true, y_pred):
+        return tf.reduce_mean(_XEloss_per_sample(y_true, y_pred))
 
-    # _metric = AUC(name="auc", multi_label=True, num_classes=NUM_CLASSES)  # give recall for metric it is more accurate
-    _metric = tf.keras.metrics.AUC(name="auc")  # give recall for metric it is more accurate
-    _callbacks = get_callbacks()
+    with strategy.scope():
+        # optimizer, with loss scaling for mixed_float16
+        _optimizer = get_optimizer(tf.keras.optimizers.Adam(LEARNING_RATE, amsgrad=True))
+        _optimizer_disc = get_optimizer(tf.keras.optimizers.Adam(DISC_LEARNING_RATE, amsgrad=True))
+
+        # _metric = AUC(name="auc", multi_label=True, num_classes=NUM_CLASSES)  # give recall for metric it is more accurate
+        _metric = tf.keras.metrics.AUC(name="auc")  # give recall for metric it is more accurate, aggregated over the replicas
+    _callbacks = get_callbacks(is_chief=_is_chief)
 
     # build CallbackList
     _callbackList = configure_callbacks(_callbacks,
@@ -93,7 +116,8 @@ if __name__ == "__main__":
 
     # save checkpoints
     checkpoint_dir = './checkpoints/disc'
-    checkpoint_prefix = os.path.join(checkpoint_dir, "ckpt")
+    # every worker saves, the others to a temporary directory
+    checkpoint_prefix = os.path.join(checkpoint_dir if _is_chief else tempfile.mkdtemp(), "ckpt")
     checkpoint = tf.train.Checkpoint(
         optimizer=_optimizer,
         optimizer_disc=_optimizer_disc,
@@ -101,14 +125,19 @@ if __name__ == "__main__":
         discriminator=discriminator)
 
 
+    # USE_XLA_STEPS, the steps of a replica with a fixed signature, XLA does not compile the multi-worker all-reduce
+    _batch_signature = get_batch_signature()
+    _compile_train_step = compile_step([_batch_signature, _batch_signature], jit_compile=strategy.num_replicas_in_sync == 1)
+
+
     class TrainWorker:
-        def __init__(self, metric, _target_dataset, lambda_adv=0.001):
+        def __init__(self, metric, lambda_adv=0.001):
             self.metric = metric
             self.lambda_adv = lambda_adv
-            self._target_dataset = iter(_target_dataset)
             self._eval_indices = tf.constant([1, 9, 8, 0, 2])
 
             self._keras_eps = tf.keras.backend.epsilon()
+            self._num_replicas = strategy.num_replicas_in_sync  # the gradients are summed over the replicas
 
         def soft_entropy(self, y_true_range: list, y_pred):
             y_true = tf.random.uniform(tf.shape(y_pred), minval=y_true_range[0], maxval=y_true_range[1])
@@ -118,11 +147,11 @@ if __name__ == "__main__":
 
                 # Notice the use of `tf.function`
         # This annotation causes the function to be "compiled".
-        @tf.function
-        def gan_train_step(self, source_image_batch, source_label_batch):
-            target_data = next(self._target_dataset)
-            target_image_batch = target_data[0]
-            target_label_batch = target_data[1]
+        @_compile_train_step
+        def gan_train_step(self, source_batch, target_batch):
+            count_retrace("gan_train_step")
+            source_image_batch, source_label_batch = source_batch
+            target_image_batch, target_label_batch = target_batch
 
             with tf.GradientTape(persistent=True) as g:
                 source_predictions = model.call_w_features(source_image_batch, training=True)
@@ -141,9 +170,9 @@ if __name__ == "__main__":
                 target_disc_output = discriminator([tf.stop_gradient(target_predictions[0]), target_predictions[1]], training=True)
 
                 # calculate xe loss
-                source_xe_loss = _XEloss(source_label_batch, source_predictions[0])
-                target_xe_loss = _XEloss(tf.gather(target_label_batch, self._eval_indices, axis=-1),
-                                         tf.gather(target_predictions[0], self._eval_indices, axis=-1))
+                source_xe_loss = _xe_loss(source_label_batch, source_predictions[0])
+                target_xe_loss = _xe_loss(tf.gather(target_label_batch, self._eval_indices, axis=-1),
+                                          tf.gather(target_predictions[0], self._eval_indices, axis=-1))
 
                 # define the label batch
                 target_label = tf.stop_gradient(target_predictions[0])
@@ -159,26 +188,31 @@ if __name__ == "__main__":
                     target_label = _target_label
                     target_disc_output = _target_disc_output
 
+                # the source and target terms are reduced separately, the batches may differ in size (DUAL_DOMAIN_TARGET_RATIO)
                 if USE_SOFT_LABEL_SMOOTHING:
-                    gen_loss = source_label * self.soft_entropy(SL_UPPERBOUND, source_disc_output) + \
-                                target_label * self.soft_entropy(SL_LOWERBOUND, target_disc_output)  # BATCH * NUM_CLASSES
-                    disc_loss = target_label * self.soft_entropy(SL_UPPERBOUND, target_disc_output) + \
-                                source_label * self.soft_entropy(SL_LOWERBOUND, source_disc_output)
+                    gen_loss = tf.reduce_mean(source_label * self.soft_entropy(SL_UPPERBOUND, source_disc_output)) + \
+                                tf.reduce_mean(target_label * self.soft_entropy(SL_LOWERBOUND, target_disc_output))
+                    disc_loss = tf.reduce_mean(target_label * self.soft_entropy(SL_UPPERBOUND, target_disc_output)) + \
+                                tf.reduce_mean(source_label * self.soft_entropy(SL_LOWERBOUND, source_disc_output))
                 else:
-                    gen_loss = source_label * tf.math.log(source_disc_output + self._keras_eps) + \
-                                target_label * tf.math.log(1 - target_disc_output + self._keras_eps)  # BATCH * NUM_CLASSES
-                    disc_loss = target_label * tf.math.log(target_disc_output + self._keras_eps) + \
-                                source_label * tf.math.log(1 - source_disc_output + self._keras_eps)
+                    gen_loss = tf.reduce_mean(source_label * tf.math.log(source_disc_output + self._keras_eps)) + \
+                                tf.reduce_mean(target_label * tf.math.log(1 - target_disc_output + self._keras_eps))
+                    disc_loss = tf.reduce_mean(target_label * tf.math.log(target_disc_output + self._keras_eps)) + \
+                                tf.reduce_mean(source_label * tf.math.log(1 - source_disc_output + self._keras_eps))
 
-                # reduce mean gen and disc
-                gen_loss = -tf.reduce_mean(gen_loss)
-                disc_loss = -tf.reduce_mean(disc_loss)
+                # negate gen and disc
+                gen_loss = -gen_loss
+                disc_loss = -disc_loss
 
                 total_loss = source_xe_loss + self.lambda_adv * gen_loss
                 # total_loss = self.lambda_adv * gen_loss
 
-            gradients_of_model = g.gradient(total_loss, model.trainable_variables)
-            gradients_of_discriminator = g.gradient(disc_loss, discriminator.trainable_variables)
+                # loss scaling for mixed_float16
+                scaled_total_loss = get_scaled_loss(_optimizer, total_loss / self._num_replicas)
+                scaled_disc_loss = get_scaled_loss(_optimizer_disc, disc_loss / self._num_replicas)
+
+            gradients_of_model = get_unscaled_gradients(_optimizer, g.gradient(scaled_total_loss, model.trainable_variables))
+            gradients_of_discriminator = get_unscaled_gradients(_optimizer_disc, g.gradient(scaled_disc_loss, discriminator.trainable_variables))
             avg_grad_model = (tf.reduce_mean(tf.concat([tf.reshape(tf.math.abs(grad), [-1]) for grad in gradients_of_model], axis=-1)))
             avg_grad_disc = (tf.reduce_mean(tf.concat([tf.reshape(tf.math.abs(grad), [-1]) for grad in gradients_of_discriminator], axis=-1)))
 
@@ -193,15 +227,19 @@ if __name__ == "__main__":
             return source_xe_loss, gen_loss, disc_loss, target_xe_loss, avg_grad_model, avg_grad_disc
 
 
-        @tf.function
-        def xe_train_step(self, source_image_batch, source_label_batch):
+        @_compile_train_step
+        def xe_train_step(self, source_batch, target_batch=None):
+            count_retrace("xe_train_step")
+            source_image_batch, source_label_batch = source_batch
+
             with tf.GradientTape(persistent=True) as g:
                 source_predictions = model(source_image_batch, training=True)
 
                 # calculate xe loss
-                source_xe_loss = _XEloss(source_label_batch, source_predictions)
+                source_xe_loss = _xe_loss(source_label_batch, source_predictions)
+                scaled_xe_loss = get_scaled_loss(_optimizer, source_xe_loss / self._num_replicas)  # loss scaling for mixed_float16
 
-            gradients_of_model = g.gradient(source_xe_loss, model.trainable_variables)
+            gradients_of_model = get_unscaled_gradients(_optimizer, g.gradient(scaled_xe_loss, model.trainable_variables))
             avg_grad_model = (
                 tf.reduce_mean(tf.concat([tf.reshape(tf.math.abs(grad), [-1]) for grad in gradients_of_model], axis=-1)))
 
@@ -212,11 +250,65 @@ if __name__ == "__main__":
             # calculate metrics
             self.metric.update_state(source_label_batch, source_predictions)
 
-            return source_xe_loss, 0, 0, 0, avg_grad_model, 0
+            zero = tf.zeros([])  # tensors, so they can be reduced over the replicas
+            return source_xe_loss, zero, zero, zero, avg_grad_model, zero
+
+        def distributed_step(self, train_step):
+            """
+            :param train_step: step of the batches of a replica
+            :return: step of the distributed batches, the gradients are all-reduced before the synchronized updates of
+                the generator and the discriminator, the losses are averaged over the replicas
+            """
+            @tf.function
+            def _distributed_step(source_batch, target_batch):
+                count_retrace("distributed_step")
+                per_replica_losses = strategy.run(train_step, args=(source_batch, target_batch))
+                # the average gradients (the last two) are of the losses divided by the amount of replicas, they are summed
+                return [strategy.reduce(tf.distribute.ReduceOp.SUM if i >= 4 else tf.distribute.ReduceOp.MEAN, loss, axis=None)
+                        for i, loss in enumerate(per_replica_losses)]
+
+            return _distributed_step
+
+        def multi_step(self, distributed_step, steps_per_call=TRAIN_STEPS_PER_CALL):
+            """
+            :param distributed_step: see distributed_step
+            :param steps_per_call: amount of steps of a single call, they run in the graph without syncing with python
+            :return: function of the iterator of the distributed batches, it returns the amount of steps it ran (0 at the
+                end of the dataset) and the losses averaged over these steps
+            """
+            @tf.function
+            def _multi_step(iterator):
+                count_retrace("multi_step")
+                num_steps = tf.constant(0)
+                loss_sums = [tf.zeros([]) for _ in range(6)]
+
+                for _ in tf.range(steps_per_call):
+                    optional_batch = iterator.get_next_as_optional()
+                    if not optional_batch.has_value():
+                        break
+                    step_losses = distributed_step(*optional_batch.get_value())
+                    loss_sums = [loss_sum + step_loss for loss_sum, step_loss in zip(loss_sums, step_losses)]
+                    num_steps += 1
+
+                return num_steps, [loss_sum / tf.cast(tf.maximum(num_steps, 1), tf.float32) for loss_sum in loss_sums]
+
+            return _multi_step
 
 
     # initiate worker
-    trainWorker = TrainWorker(_metric, _target_dataset=train_target_dataset, lambda_adv=LAMBDA_ADV)
+    trainWorker = TrainWorker(_metric, lambda_adv=LAMBDA_ADV)
+    g = trainWorker.distributed_step(trainWorker.gan_train_step if USE_GAN else trainWorker.xe_train_step)
+
+    # data echoing, "auto" measures the input and step times on the pipeline without echoing
+    echo_factor = DATA_ECHO_FACTOR
+    if echo_factor == "auto":
+        echo_factor = estimate_echo_factor(get_train_dataset(), lambda batch: g(*batch),
+                                           [model, discriminator], [_optimizer, _optimizer_disc], [_metric])  # restored after the measured steps
+        # the workers must run the same amount of steps, they take the mean of their estimates
+        echo_factor = int(round(strategy.reduce(tf.distribute.ReduceOp.MEAN,
+                                                strategy.run(lambda: tf.constant(float(echo_factor))), axis=None).numpy()))
+    train_dataset = get_train_dataset(echo_factor)
+    _multi_step = trainWorker.multi_step(g)
 
     ## find initial epoch and load the weights too
     init_epoch = 0
@@ -246,7 +338,6 @@ if __name__ == "__main__":
         [loss.reset_states() for loss in losses]
 
         # g = trainWorker.gan_train_step if USE_DOM_ADAP_NET and (epoch % 2) else trainWorker.xe_train_step
-        g = trainWorker.gan_train_step if USE_GAN else trainWorker.xe_train_step
 
         # if USE_AUGMENTATION:
         #     if epoch % 2:
@@ -256,18 +347,20 @@ if __name__ == "__main__":
         # else:
         #     train_dataset = noaug_train_dataset
 
-        with tqdm(total=math.ceil(TRAIN_N / BATCH_SIZE),
-                  postfix=[dict()]) as t:
-            for i_batch, (source_image_batch, source_label_batch) in enumerate(train_dataset):
-                _batch_size = tf.shape(source_image_batch)[0].numpy()
-                _callbackList.on_batch_begin(i_batch, {"size": _batch_size})  # on batch begin
-
-                _losses = g(source_image_batch, source_label_batch)
+        with tqdm(total=math.ceil(TRAIN_N / BATCH_SIZE) * echo_factor,
+                  postfix=[dict()], disable=not _is_chief) as t:
+            train_iterator = iter(train_dataset)
+            i_batch = 0
+            while True:
+                _num_steps, _losses = _multi_step(train_iterator)
+                _num_steps = _num_steps.numpy()
+                if not _num_steps:  # end of the epoch
+                    break
                 _auc = trainWorker.metric.result().numpy()
 
-                # update loss
-                [losses[i].update_state(_losses[i]) for i in range(num_losses - 1)]
-                losses[num_losses - 1].update_state(_auc)
+                # update loss, weighted by the amount of steps of the call
+                [losses[i].update_state(_losses[i], sample_weight=_num_steps) for i in range(num_losses - 1)]
+                losses[num_losses - 1].update_state(_auc, sample_weight=_num_steps)
 
                 # update tqdm
                 # t.postfix[0]["_g"] = update_gen
@@ -279,9 +372,13 @@ if __name__ == "__main__":
                 t.postfix[0]["avg_g_d"] = losses[5].result().numpy()
                 t.postfix[0]["AUC"] = losses[6].result().numpy()
 
-                t.update()
+                t.update(_num_steps)
 
-                _callbackList.on_batch_end(i_batch, {"loss": losses[0].result()})  # on batch end
+                # the callbacks see every step of the call afterwards, with USE_CLR a call is a single step
+                for _ in range(_num_steps):
+                    _callbackList.on_batch_begin(i_batch, {"size": BATCH_SIZE})  # on batch begin
+                    _callbackList.on_batch_end(i_batch, {"loss": losses[0].result()})  # on batch end
+                    i_batch += 1
 
         # epoch_end
         print()
@@ -297,6 +394,7 @@ if __name__ == "__main__":
                                            "auc": _auc,
                                            "val_loss": results[0],
                                            "val_auc": results[1],
+                                           "retraces": get_num_retraces(),
                                            "lr": model.optimizer.lr})  # on epoch end
 
         # reset states
@@ -4,6 +4,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 from math import ceil
 import datetime
+import json
+import os
 
 # import os
 # os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
@@ -13,10 +15,11 @@ colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
 tf.random.set_seed(0)
 np.random.seed(0)
 
-# # On TPUs, use 'mixed_bfloat16' instead
-# from tensorflow.keras.mixed_precision import experimental as mixed_precision
-# policy = tf.keras.mixed_precision.experimental.Policy('mixed_float16')
-# mixed_precision.set_policy(policy)
+# mixed precision, the variables stay float32 and the heads output float32
+# None is float32, 'mixed_float16' on GPUs (with loss scaling), 'mixed_bfloat16' on CPUs and TPUs
+MIXED_PRECISION_POLICY = None
+if MIXED_PRECISION_POLICY:
+    tf.keras.mixed_precision.set_global_policy(MIXED_PRECISION_POLICY)
 
 # common global variables
 IMAGE_INPUT_SIZE = 224  # this is because of Xception
@@ -42,12 +45,20 @@ NUM_FEATURES = 2048 + (PAT_DATA_SIZE if USE_PATIENT_DATA else 0)
 # USE_CLASS_WEIGHT = False
 USE_SPARSITY_NORM = False
 USE_AUGMENTATION = False
+USE_IN_MODEL_PREPROCESS = False  # the input pipeline yields uint8 images, normalization is done inside the model
+USE_PREPROCESS_IMG = True  # normalization inside the model, Xception scaling (-1~1) or 0~1, the pipelines must use the same
+USE_XLA_STEPS = False  # XLA compile the train steps and the GANModel calls with fixed input signatures, see utils/xla.py
+TRAIN_STEPS_PER_CALL = 1  # train steps of a single call in the graph, the losses, AUC and progress bar are updated after each call
 USE_GAN = True
 USE_CLR = False
+# CyclicLR sets the lr after every step from on_batch_end, which only runs between the calls, so a single step per call.
+# step_decay sets it per epoch and works with any TRAIN_STEPS_PER_CALL
+TRAIN_STEPS_PER_CALL = 1 if USE_CLR else TRAIN_STEPS_PER_CALL
 USE_EARLY_STOPPING = False
 MODELCKP_BEST_ONLY = not USE_DOM_ADAP_NET
 USE_DROPOUT_PAT_DATA = True
 BUFFER_SIZE = 16000
+CLASS_BALANCED_FREQUENCIES = None  # target frequency of every class (+ one for rows without findings) for read_dataset(class_balanced=True), None is uniform
 BATCH_SIZE = 32  # 32 is optimal
 # BUFFER_SIZE = 1600
 # BATCH_SIZE = 16  # 32 is optimal
@@ -63,6 +74,7 @@ USE_NOISY_LABEL = False
 SL_LOWERBOUND = [0.0, 0.1]
 SL_UPPERBOUND = [0.9, 1.0]
 NOISY_LABEL_PERCENTAGE = ceil(5./100. * BATCH_SIZE)
+DUAL_DOMAIN_TARGET_RATIO = 1.  # target batch size relative to the source batch size in read_dual_domain_dataset
 
 # eval settings
 EVAL_CHEXPERT = True  # important if false then, it is trained on chestxray14
@@ -73,6 +85,7 @@ LABELS_COUPLE_INDEX = [
     [2, 5, 6, 8, 10, 7, 9],  # CheXpert
     [1, 9, 8, 0, 2, 6, 7]
 ]
+MULTI_SOURCE_WEIGHTS = [.5, .5]  # sampling weight of every source (in the order of LABELS_COUPLE_INDEX) in read_multi_source_dataset
 
 # for manifold learning
 MODEL_SVM_PATH = "/mnt/7E8EEE0F8EEDBFAF/project/bachelorThesis/records/all_trainings/20200126-034328/checkpoints/model_weights.04-0.86.hdf5"
@@ -112,6 +125,23 @@ AUC_RESULTS_PATH = "./report/results/AUC.txt"
 
 # dataset common
 VALID_RATIO = 10 / 100
+JPEG_DCT_SCALING = True  # decode JPEGs at 1/2, 1/4 or 1/8 scale when they are at least that much larger than IMAGE_INPUT_SIZE
+IMAGE_SHARDS_N = 64  # amount of shards for the pre-decoded image TFRecords
+TFRECORD_SHARDS_N = 16  # amount of shards for the path TFRecords of the train split
+TFRECORD_COMPRESSION = None  # None, "GZIP" or "ZLIB"
+TFRECORD_INTERLEAVE_CYCLE = 16  # amount of shards read in parallel
+DATASET_CACHE_DIR = "./dataset_cache"  # decoded and normalized streams, keyed by the preprocessing constants
+CACHE_BATCH_SIZE = 256  # batch size while filling the cache
+CACHE_SHUFFLE_BUFFER = 2048  # decoded images, the records can not be shuffled before decoding when they are cached
+DATA_ECHO_FACTOR = 1  # emit every decoded batch this many times when the training is input bound, "auto" measures it
+DATA_ECHO_MAX_FACTOR = 4  # upper bound of the measured echo factor
+DATA_ECHO_SHUFFLE_BUFFER = 8  # batches, so the echoes of a batch do not follow each other
+DATA_SERVICE_ADDRESS = None  # tf.data service that runs the train pipelines, e.g. "grpc://host:5050", "local" starts one, see datasets/data_service.py
+DATA_SERVICE_PORT = 5050  # port of the dispatcher
+DATA_SERVICE_WORKERS = 2  # amount of local worker processes
+DATA_SERVICE_PROCESSING_MODE = "distributed_epoch"  # split the shards between the workers, needs a TFRecord of several shards, else "parallel_epochs"
+MULTI_WORKER_N = 2  # amount of local training workers of multi_worker_launcher.py, the cluster is set by TF_CONFIG
+MULTI_WORKER_PORT = 12345  # port of the first local training worker
 
 # cheXpert dataset
 CHEXPERT_TRAIN_TARGET_TFRECORD_PATH = './cheXpert_datasets/CheXpert_train.tfrecord'
@@ -119,6 +149,20 @@ CHEXPERT_VALID_TARGET_TFRECORD_PATH = './cheXpert_datasets/CheXpert_valid.tfreco
 CHEXPERT_TEST_TARGET_TFRECORD_PATH = './cheXpert_datasets/CheXpert_test.tfrecord'
 CHEXPERT_DATASET_PATH = "../datasets"
 
+# pre-decoded and resized images, see write_csv_to_image_shards
+CHEXPERT_TRAIN_IMAGE_SHARDS_PATH = './cheXpert_datasets/CheXpert_train_%dpx.tfrecord' % IMAGE_INPUT_SIZE
+CHEXPERT_VALID_IMAGE_SHARDS_PATH = './cheXpert_datasets/CheXpert_valid_%dpx.tfrecord' % IMAGE_INPUT_SIZE
+CHEXPERT_TEST_IMAGE_SHARDS_PATH = './cheXpert_datasets/CheXpert_test_%dpx.tfrecord' % IMAGE_INPUT_SIZE
+
+# memory-mapped uint8 image caches, one sub folder per split (train, valid, test), see write_memmap_cache
+CHEXPERT_MEMMAP_DIR = './cheXpert_datasets/memmap_%dpx' % IMAGE_INPUT_SIZE
+
+# labels, patient datas and splits keyed by image path, see datasets/metadata_index.py
+CHEXPERT_METADATA_INDEX_PATH = './cheXpert_datasets/CheXpert_index.npz'
+
+# class counts, class weights, K_SN and pixel statistics of the train split, see datasets/dataset_statistics.py
+CHEXPERT_STATISTICS_PATH = './cheXpert_datasets/CheXpert_train_statistics.json'
+
 CHEXPERT_TRAIN_N = 201073
 CHEXPERT_VAL_N = 22341
 CHEXPERT_TEST_N = 234
@@ -133,6 +177,16 @@ CHESTXRAY_VALID_TARGET_TFRECORD_PATH = 'cheXray14_datasets/CheXray14_valid.tfrec
 CHESTXRAY_TEST_TARGET_TFRECORD_PATH = 'cheXray14_datasets/CheXray14_test.tfrecord'
 CHESTXRAY_DATASET_PATH = "../datasets/chestXray14/images"
 
+CHESTXRAY_TRAIN_IMAGE_SHARDS_PATH = 'cheXray14_datasets/CheXray14_train_%dpx.tfrecord' % IMAGE_INPUT_SIZE
+CHESTXRAY_VALID_IMAGE_SHARDS_PATH = 'cheXray14_datasets/CheXray14_valid_%dpx.tfrecord' % IMAGE_INPUT_SIZE
+CHESTXRAY_TEST_IMAGE_SHARDS_PATH = 'cheXray14_datasets/CheXray14_test_%dpx.tfrecord' % IMAGE_INPUT_SIZE
+
+CHESTXRAY_MEMMAP_DIR = 'cheXray14_datasets/memmap_%dpx' % IMAGE_INPUT_SIZE
+
+CHESTXRAY_METADATA_INDEX_PATH = 'cheXray14_datasets/CheXray14_index.npz'
+
+CHESTXRAY_STATISTICS_PATH = 'cheXray14_datasets/CheXray14_train_statistics.json'
+
 CHESTXRAY_TRAIN_N = 77872
 CHESTXRAY_VAL_N = 8652
 CHESTXRAY_TEST_N = 25596
@@ -141,23 +195,67 @@ CHESTXRAY_LABELS_KEY = ["Atelectasis", "Cardiomegaly", "Effusion", "Infiltration
                         "Pneumothorax", "Consolidation", "Edema", "Emphysema", "Fibrosis", "Pleural_Thickening",
                         "Hernia"]
 
+# synthetic dataset with the same TFRecord schema, see datasets/synthetic_dataset.py
+USE_SYNTHETIC_DATASET = False  # replace both datasets with the synthetic one, to benchmark and test without the licensed images
+SYNTHETIC_TRAIN_TARGET_TFRECORD_PATH = './synthetic_datasets/Synthetic_train.tfrecord'
+SYNTHETIC_VALID_TARGET_TFRECORD_PATH = './synthetic_datasets/Synthetic_valid.tfrecord'
+SYNTHETIC_TEST_TARGET_TFRECORD_PATH = './synthetic_datasets/Synthetic_test.tfrecord'
+SYNTHETIC_DATASET_PATH = './synthetic_datasets/images'
+SYNTHETIC_STATISTICS_PATH = './synthetic_datasets/Synthetic_train_statistics.json'
+SYNTHETIC_N = 2000  # amount of images
+SYNTHETIC_TEST_RATIO = 10 / 100
+SYNTHETIC_PREVALENCE = 10 / 100  # positive rate of every class, a float or a list of NUM_CLASSES floats
+SYNTHETIC_IMAGE_SIZE = (390, 320)  # height, width, like CheXpert-v1.0-small
+
+if USE_SYNTHETIC_DATASET:
+    CHEXPERT_TRAIN_TARGET_TFRECORD_PATH = CHESTXRAY_TRAIN_TARGET_TFRECORD_PATH = SYNTHETIC_TRAIN_TARGET_TFRECORD_PATH
+    CHEXPERT_VALID_TARGET_TFRECORD_PATH = CHESTXRAY_VALID_TARGET_TFRECORD_PATH = SYNTHETIC_VALID_TARGET_TFRECORD_PATH
+    CHEXPERT_TEST_TARGET_TFRECORD_PATH = CHESTXRAY_TEST_TARGET_TFRECORD_PATH = SYNTHETIC_TEST_TARGET_TFRECORD_PATH
+    CHEXPERT_DATASET_PATH = CHESTXRAY_DATASET_PATH = SYNTHETIC_DATASET_PATH
+    CHEXPERT_STATISTICS_PATH = CHESTXRAY_STATISTICS_PATH = SYNTHETIC_STATISTICS_PATH
+    if os.path.exists(SYNTHETIC_STATISTICS_PATH):  # the counts of the patient level splits, see write_synthetic_dataset
+        with open(SYNTHETIC_STATISTICS_PATH) as _f:
+            _split_n = json.load(_f)["split_n"]
+        CHEXPERT_TRAIN_N = CHESTXRAY_TRAIN_N = _split_n["train"]
+        CHEXPERT_VAL_N = CHESTXRAY_VAL_N = _split_n["valid"]
+        CHEXPERT_TEST_N = CHESTXRAY_TEST_N = _split_n["test"]
+    else:  # not written yet
+        CHEXPERT_TEST_N = CHESTXRAY_TEST_N = round(SYNTHETIC_N * SYNTHETIC_TEST_RATIO)
+        CHEXPERT_VAL_N = CHESTXRAY_VAL_N = round((SYNTHETIC_N - CHEXPERT_TEST_N) * VALID_RATIO)
+        CHEXPERT_TRAIN_N = CHESTXRAY_TRAIN_N = SYNTHETIC_N - CHEXPERT_TEST_N - CHEXPERT_VAL_N
+
 # conclusion of dataset
 if TRAIN_CHEXPERT:
     TRAIN_TARGET_TFRECORD_PATH = CHEXPERT_TRAIN_TARGET_TFRECORD_PATH
     VALID_TARGET_TFRECORD_PATH = CHEXPERT_VALID_TARGET_TFRECORD_PATH
     TEST_TARGET_TFRECORD_PATH = CHEXPERT_TEST_TARGET_TFRECORD_PATH
+    TRAIN_IMAGE_SHARDS_PATH = CHEXPERT_TRAIN_IMAGE_SHARDS_PATH
+    VALID_IMAGE_SHARDS_PATH = CHEXPERT_VALID_IMAGE_SHARDS_PATH
+    TEST_IMAGE_SHARDS_PATH = CHEXPERT_TEST_IMAGE_SHARDS_PATH
+    MEMMAP_DIR = CHEXPERT_MEMMAP_DIR
+    METADATA_INDEX_PATH = CHEXPERT_METADATA_INDEX_PATH
+    DATASET_STATISTICS_PATH = CHEXPERT_STATISTICS_PATH
     DATASET_PATH = CHEXPERT_DATASET_PATH
     TRAIN_N = CHEXPERT_TRAIN_N
     VAL_N = CHEXPERT_VAL_N
     LABELS_KEY = CHEXPERT_LABELS_KEY
+    DATASET_NAME = "CheXpert"
 else:
     TRAIN_TARGET_TFRECORD_PATH = CHESTXRAY_TRAIN_TARGET_TFRECORD_PATH
     VALID_TARGET_TFRECORD_PATH = CHESTXRAY_VALID_TARGET_TFRECORD_PATH
     TEST_TARGET_TFRECORD_PATH = CHESTXRAY_TEST_TARGET_TFRECORD_PATH
+    TRAIN_IMAGE_SHARDS_PATH = CHESTXRAY_TRAIN_IMAGE_SHARDS_PATH
+    VALID_IMAGE_SHARDS_PATH = CHESTXRAY_VALID_IMAGE_SHARDS_PATH
+    TEST_IMAGE_SHARDS_PATH = CHESTXRAY_TEST_IMAGE_SHARDS_PATH
+    MEMMAP_DIR = CHESTXRAY_MEMMAP_DIR
+    METADATA_INDEX_PATH = CHESTXRAY_METADATA_INDEX_PATH
+    DATASET_STATISTICS_PATH = CHESTXRAY_STATISTICS_PATH
     DATASET_PATH = CHESTXRAY_DATASET_PATH
     TRAIN_N = CHESTXRAY_TRAIN_N
     VAL_N = CHESTXRAY_VAL_N
     LABELS_KEY = CHESTXRAY_LABELS_KEY
+    DATASET_NAME = "ChestX-ray14"
+DATASET_NAME = "Synthetic" if USE_SYNTHETIC_DATASET else DATASET_NAME  # the statistics file is only loaded for this dataset
 
 if EVAL_CHEXPERT:
     TEST_N = CHEXPERT_TEST_N
@@ -213,6 +311,7 @@ CHEXPERT_CLASS_WEIGHT = \
               [0.51415589, 18.16049494],
               [0.52251997, 11.60125779],
               [1.05021989, 0.9543638]])
+CLASS_WEIGHT = CHEXPERT_CLASS_WEIGHT if DATASET_NAME == "CheXpert" else None  # of the trained dataset
 
 # K_SN cannot be 0.
 if IMAGE_INPUT_SIZE == 320:
@@ -222,6 +321,21 @@ elif IMAGE_INPUT_SIZE == 224:
 else:
     K_SN = 1.
 
+# the statistics file of the trained dataset overrides the hardcoded numbers above
+DATASET_STATISTICS_VERSION = 2
+if os.path.exists(DATASET_STATISTICS_PATH):
+    with open(DATASET_STATISTICS_PATH) as _f:
+        _statistics = json.load(_f)
+
+    if _statistics.get("version") == DATASET_STATISTICS_VERSION and _statistics["dataset"] == DATASET_NAME:
+        pos = dict(enumerate(_statistics["pos"]))
+        neg = dict(enumerate(_statistics["neg"]))
+        CLASS_WEIGHT = np.array(_statistics["class_weight"])
+        TRAIN_N = _statistics["n"]  # grows with appended rows
+
+        if _statistics["image_input_size"] == IMAGE_INPUT_SIZE:  # K_SN depends on the input size
+            K_SN = _statistics["k_sn"]
+
 FEATURES_NP_FILE_1 = "../records/chextpert_train_input_features"
 FEATURES_NP_FILE_2 = "../records/chestray14_train_input_features"
 
@@ -7,7 +7,7 @@ Dataset will be stored in tf.data.Dataset. Patient data and image will be combin
 """
 
 from datasets.common import *
-import csv
+from datasets.metadata_index import MetadataIndex
 np.random.seed(666)
 
 
@@ -27,39 +27,27 @@ def read_CheXpert_csv(csv_path, statistics=True):
 	:return: (keys, (image, patient data, label))
 	"""
 
-	# read train csv
-	paths = []  # save path of image
+	# read train csv in one pass, every column is converted in bulk
+	df = pd.read_csv(csv_path)
 
-	with open(csv_path, newline='') as train_csv:
-		csvreader = csv.reader(train_csv, delimiter=',')
+	# parse the keys
+	path_key = df.columns[0]
+	patient_data_key = list(df.columns[1:5])
+	labels_key = list(df.columns[5:])
 
-		total_row = (sum(1 for _ in csvreader)) - 1  # total for every row in csv minus one for the key
-		train_csv.seek(0)
+	paths = df[path_key].to_numpy(dtype=str)  # save path of image
 
-		patient_datas = np.zeros((total_row, 4))
-		labels = np.zeros((total_row, 14))
+	patient_datas = np.stack([
+		map_half_plus_one(df[patient_data_key[0]], "Female", "Male"),  # sex
+		np.minimum(df[patient_data_key[1]].to_numpy(dtype=float), 100.) / 100.,  # maximum age is 100 (range output is 0. to 1.)
+		map_half_plus_one(df[patient_data_key[2]], "Frontal", "Lateral"),  # f/l
+		map_half_plus_one(df[patient_data_key[3]], "AP", "PA"),  # f/l
+	], axis=1)
 
-		for i_row, row in enumerate(csvreader):
-			if not i_row:
-				# parse the keys to dict
-				path_key = row[0]
-				patient_data_key = row[1:5]
-				labels_key = row[5:]
-			else:
-				# save data
-				paths.append(row[0])
+	labels = df[labels_key].fillna(0.).to_numpy(dtype=float)
+	labels[labels == -1] = 1.  # U-Ones
 
-				patient_data = (row[1:5])
-				patient_data[0] = convert_to_half_plus_one(patient_data[0], "Female", "Male")  # sex
-				patient_data[1] = min(float(patient_data[1]), 100.) / 100.  # maximum age is 100 (range output is 0. to 1.)
-				patient_data[2] = convert_to_half_plus_one(patient_data[2], "Frontal", "Lateral")  # f/l
-				patient_data[3] = convert_to_half_plus_one(patient_data[3], "AP", "PA")  # f/l
-				patient_datas[i_row-1] = patient_data
-
-				label = row[5:]
-				label = map(lambda l: 0 if l == '' else float(l), label)
-				label = map(lambda l: 1 if l == -1 else l, label)  # U-Ones
-				labels[i_row-1] = list(label)
+	total_row = len(paths)
 
 	if statistics : statisticsCheXpert(labels)
 
@@ -72,27 +60,30 @@ if __name__ == "__main__":
 	# valids, trains = seperate_train_valid(paths, patient_datas, labels, total_row)
 	#
 	# write_csv_to_tfrecord(valids, valid_target_tfrecord_path)
-	# write_csv_to_tfrecord(trains, train_target_tfrecord_path)
+	# write_csv_to_tfrecord(trains, train_target_tfrecord_path, num_shards=TFRECORD_SHARDS_N)  # written in parallel, read_TFRecord interleaves the shards
 	#
 	# get test set
 	# (_, _, labels_key), tests, total_row = read_CheXpert_csv(valid_csv_file)
 	# write_csv_to_tfrecord(tests, test_target_tfrecord_path)
 
+	# # persist labels, patient datas and splits keyed by image path
+	# MetadataIndex.build({"train": trains, "valid": valids, "test": tests}).save("../" + CHEXPERT_METADATA_INDEX_PATH)
+
+	# # pre-decoded and resized image shards, read them with read_dataset(..., use_decoded_shards=True)
+	# write_csv_to_image_shards(valids, dataset_path, "../" + CHEXPERT_VALID_IMAGE_SHARDS_PATH)
+	# write_csv_to_image_shards(trains, dataset_path, "../" + CHEXPERT_TRAIN_IMAGE_SHARDS_PATH)
+	# write_csv_to_image_shards(tests, dataset_path, "../" + CHEXPERT_TEST_IMAGE_SHARDS_PATH, num_shards=1)
+
+	# # memory-mapped uint8 caches, read them with read_dataset(..., memmap_dir=os.path.join(CHEXPERT_MEMMAP_DIR, "train"))
+	# for split, tfrecord_path in [("train", train_target_tfrecord_path), ("valid", valid_target_tfrecord_path), ("test", test_target_tfrecord_path)]:
+	# 	write_memmap_cache(tfrecord_path, dataset_path, os.path.join("..", CHEXPERT_MEMMAP_DIR, split))
+
 	# # reading
 	# train_dataset = read_dataset(test_target_tfrecord_path, dataset_path)
 	# for image_features in train_dataset.take(1):
 	# 	print(image_features)
 
-	# calculate K_SN
+	# class weights and K_SN: python -m datasets.dataset_statistics
 	train_dataset = read_dataset(TRAIN_TARGET_TFRECORD_PATH, DATASET_PATH)
 	for i in train_dataset.take(1):
-		print(i[1].shape)
-	# print(calculate_K_SN(train_dataset))
-
-	# calculate class weight
-	# train_labels = []
-	# # get the ground truth labels
-	# for _, train_label in tqdm(train_dataset):
-	# 	train_labels.extend(train_label)
-	# train_labels = np.array(train_labels)
-	# print(calculating_class_weights(train_labels))
\ No newline at end of file
+		print(i[1].shape)
\ No newline at end of file
@@ -2,9 +2,10 @@
 ChestXray14 API
 """
 
+import argparse
 from common_definitions import *
 from datasets.common import *
-import csv
+from datasets.metadata_index import MetadataIndex
 
 # all the variables
 dataset_path = "/mnt/7E8EEE0F8EEDBFAF/project/bachelorThesis/datasets/chestXray14/images"
@@ -21,62 +22,45 @@ def read_CheXray14_csv(csv_path, statistics=True, opt_paths=None):
 	"""
 
 	:param csv_path:
+	:param opt_paths: only keep these image indexes, the order of the csv is kept
 	:return: (keys, (image, patient data, label))
 	"""
 
-	# read train csv
-	paths = []  # save path of image
+	# parse the keys to dict
+	path_key = "Image Index"
+	patient_data_key = ["Patient Gender", "Patient Age", "Frontal/Lateral", "AP/PA"]
+	labels_key = CHESTXRAY_LABELS_KEY
 
-	with open(csv_path, newline='') as train_csv:
-		csvreader = csv.reader(train_csv, delimiter=',')
+	# read the csv in one pass
+	df = pd.read_csv(csv_path, usecols=[path_key, "Finding Labels", "Patient Age", "Patient Gender", "View Position"])
 
-		total_row = (sum(1 for _ in csvreader)) - 1  # total for every row in csv minus one for the key
-		train_csv.seek(0)
+	if opt_paths is not None:
+		df = df[df[path_key].isin(set(opt_paths))]  # hashed membership test
 
-		patient_datas = np.zeros((total_row, 4))
-		labels = np.zeros((total_row, NUM_CLASSES))
+	paths = df[path_key].to_numpy(dtype=str)  # save path of image
 
-		# parse the keys to dict
-		path_key = "Image Index"
-		patient_data_key = ["Patient Gender", "Patient Age", "Frontal/Lateral", "AP/PA"]
-		labels_key = CHESTXRAY_LABELS_KEY
+	patient_datas = np.stack([
+		map_half_plus_one(df["Patient Gender"], "F", "M"),  # sex
+		np.minimum(df["Patient Age"].to_numpy(dtype=float), 100.) / 100.,  # maximum age is 100 (range output is 0. to 1.)
+		np.zeros(len(df)),  # f/l
+		map_half_plus_one(df["View Position"], "AP", "PA"),  # f/l
+	], axis=1)
 
-		next(csvreader)  # to remove the header
-		for i_row, row in enumerate(csvreader):
-			image_index = row[0]
+	# one hot of the "|" separated findings, "No Finding" is dropped
+	labels = df["Finding Labels"].str.get_dummies(sep="|").reindex(columns=labels_key, fill_value=0).to_numpy(dtype=float)
 
-			if opt_paths is not None:
-				if not image_index in opt_paths:
-					continue
-
-			label = row[1].split("|")
-			gender = row[5]
-			age = row[4]
-			view_position = row[6]
-
-			# save data
-			paths.append(image_index)
-
-			patient_data = []
-			patient_data.append(convert_to_half_plus_one(gender, "F", "M"))  # sex
-			patient_data.append(min(float(age), 100.) / 100.)  # maximum age is 100 (range output is 0. to 1.)
-			patient_data.append(0.)  # f/l
-			patient_data.append(convert_to_half_plus_one(view_position, "AP", "PA"))  # f/l
-			patient_datas[i_row-1] = patient_data
-
-			temp = np.zeros(NUM_CLASSES)
-
-			try: label.remove("No Finding")
-			except: pass # remove no finding
-
-			temp[list(map(lambda x: labels_key.index(x), label))] = 1.
-			labels[i_row] = temp
+	total_row = len(paths)
 
 	if statistics : statisticsCheXpert(labels, NUM_CLASSES, CHESTXRAY_LABELS_KEY)
 
 	return (path_key, patient_data_key, labels_key), (paths, patient_datas, labels), total_row
 
 if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="write the ChestX-ray14 TFRecords and metadata index")
+	parser.add_argument("--write-image-shards", action="store_true", help="also write the pre-decoded and resized image shards")
+	parser.add_argument("--write-memmap", action="store_true", help="also write the memory-mapped uint8 image caches")
+	args = parser.parse_args()
+
 	# save to TFRecord
 	with open(train_csv_file, "r") as f:  # train csv
 		train_paths = [line.strip() for line in f]
@@ -84,18 +68,16 @@ if __name__ == "__main__":
 	with open(test_csv_file, "r") as f:  # test csv
 		test_paths = [line.strip() for line in f]
 
-	(_, _, labels_key), (paths, patient_datas, labels), total_row = read_CheXray14_csv(data_csv_file, statistics=True, opt_paths=test_paths)
-
-	exit()
+	(_, _, labels_key), (paths, patient_datas, labels), total_row = read_CheXray14_csv(data_csv_file, statistics=True)
 
-	dict_patient_datas = dict(zip(paths, patient_datas))
-	dict_labels = dict(zip(paths, labels))
+	# path -> row lookups of the whole csv
+	data_index = MetadataIndex.build({"all": (paths, patient_datas, labels)})
 
 	def get_patient_datas(paths):
-		return np.array([dict_patient_datas[t_p] for t_p in paths])
+		return data_index.get_patient_datas(paths)
 
 	def get_labels(paths):
-		return np.array([dict_labels[t_p] for t_p in paths])
+		return data_index.get_labels(paths)
 
 	# write TFrecords valids and trains
 	valids, trains = seperate_train_valid(np.array(train_paths), get_patient_datas(train_paths), get_labels(train_paths), len(train_paths))
@@ -106,6 +88,21 @@ if __name__ == "__main__":
 	# write TFrecords tests
 	write_csv_to_tfrecord((np.array(test_paths), get_patient_datas(test_paths), get_labels(test_paths)), test_target_tfrecord_path)
 
+	# persist labels, patient datas and splits keyed by image path
+	MetadataIndex.build({"train": trains, "valid": valids,
+						 "test": (np.array(test_paths), get_patient_datas(test_paths), get_labels(test_paths))}).save(CHESTXRAY_METADATA_INDEX_PATH)
+
+	# pre-decoded and resized image shards, read them with read_dataset(..., use_decoded_shards=True)
+	if args.write_image_shards:
+		write_csv_to_image_shards(valids, dataset_path, CHESTXRAY_VALID_IMAGE_SHARDS_PATH)
+		write_csv_to_image_shards(trains, dataset_path, CHESTXRAY_TRAIN_IMAGE_SHARDS_PATH)
+		write_csv_to_image_shards((np.array(test_paths), get_patient_datas(test_paths), get_labels(test_paths)), dataset_path, CHESTXRAY_TEST_IMAGE_SHARDS_PATH)
+
+	# memory-mapped uint8 caches, read them with read_dataset(..., memmap_dir=os.path.join(CHESTXRAY_MEMMAP_DIR, "train"))
+	if args.write_memmap:
+		for split, tfrecord_path in [("train", train_target_tfrecord_path), ("valid", valid_target_tfrecord_path), ("test", test_target_tfrecord_path)]:
+			write_memmap_cache(tfrecord_path, dataset_path, os.path.join(CHESTXRAY_MEMMAP_DIR, split))
+
 	train_dataset = read_dataset(train_target_tfrecord_path, dataset_path, num_class=NUM_CLASSES)
 	for i in train_dataset.take(1):
 		print(i)
\ No newline at end of file
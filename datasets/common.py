@@ -1,23 +1,23 @@
 import os
+import time
+import hashlib
+import multiprocessing
 import pandas as pd
 from common_definitions import *
 from tqdm import tqdm
 import skimage.io
 import skimage.transform
 from utils.augmentations import *
+from utils.utils import get_and_mkdir
+from datasets.metadata_index import MetadataIndex, build_class_rows
 
 
 def statisticsCheXpert(labels, num_class=14, labels_key=LABELS_KEY):
-    totals = np.zeros((num_class, 2))
+    labels = labels[:, :num_class]
+    totals = np.stack([labels.sum(axis=0), (labels == 0).sum(axis=0)], axis=1)
 
     for i in range(num_class):
-        label = labels[:, i]
-
-        total_positive = label.sum()
-        total_negative = (label == 0).sum()
-        print("%s: pos. = %d ; neg. = %d" % (labels_key[i], total_positive, total_negative))
-
-        totals[i] = (total_positive, total_negative)
+        print("%s: pos. = %d ; neg. = %d" % (labels_key[i], totals[i, 0], totals[i, 1]))
 
     df = pd.DataFrame(totals, index=labels_key, columns=["pos.", "neg."])
     df.plot.bar()
@@ -30,6 +30,14 @@ def convert_to_half_plus_one(variable, half_one_val, plus_one_val):
     return .5 if variable == half_one_val else 1 if variable == plus_one_val else 0
 
 
+def map_half_plus_one(values, half_one_val, plus_one_val):
+    """
+    Vectorized convert_to_half_plus_one for a whole column
+    """
+    values = np.asarray(values)
+    return np.select([values == half_one_val, values == plus_one_val], [.5, 1.], 0.)
+
+
 # The following functions can be used to convert a value to a type compatible
 # with tf.Example.
 
@@ -50,41 +58,118 @@ def _int64_feature(value):
     return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
 
 
-def sparsity_norm(a, k_sn=K_SN):
+def sparsity_norm(a, k_sn=K_SN, axis=None):
+    """
+    :param axis: axes of a single sample, e.g. [-3, -2, -1] for (batched) images, None for the whole tensor
+    """
     mask = tf.where(a > 0., 1., 0.)
-    norm_m = tf.reduce_sum(mask)
+    norm_m = tf.reduce_sum(mask, axis=axis, keepdims=axis is not None)
     return k_sn * a / norm_m
 
 
-def seperate_train_valid(paths, patient_datas, labels, total_row):
-    paths = paths[:, np.newaxis]
-    ori_trains = np.concatenate([paths, patient_datas, labels], axis=1)
-    np.random.shuffle(ori_trains)  # shuffle the array
+def get_patient_ids(paths):
+    """
+    Patient ID of every image path, the "patientXXXXX" folder of CheXpert or the "XXXXXXXX" prefix of the
+    ChestX-ray14 file names, otherwise the path itself
+    """
+    paths = pd.Series(np.asarray(paths, dtype=str))
+    chexpert_ids = paths.str.extract(r"(patient\d+)", expand=False)
+    chestxray_ids = paths.str.extract(r"(?:^|/)(\d+)_\d+\.\w+$", expand=False)
+    return chexpert_ids.fillna(chestxray_ids).fillna(paths).to_numpy(dtype=str)
+
+
+def split_train_valid_indices(paths, labels, valid_ratio=VALID_RATIO, seed=None):
+    """
+    Patient level, stratified split into row indices. All images of a patient land in the same split.
+    Every patient is stratified by its rarest positive class (or by having no findings) and in every stratum
+    valid_ratio of the images is given to the valid split, patient by patient in a random order.
+    :param seed: None draws it from the global np.random, seeded in common_definitions, so the split is reproducible
+    :return: (valid indices, train indices), both in a random order
+    """
+    rng = np.random.default_rng(np.random.randint(2 ** 31) if seed is None else seed)
+    patient_codes, _ = pd.factorize(get_patient_ids(paths))
+    patient_labels = pd.DataFrame(np.asarray(labels) > .5).groupby(patient_codes).max().to_numpy()  # n_patient * n_class
+    patient_sizes = np.bincount(patient_codes)
+    num_class = patient_labels.shape[1]
+
+    # stratum of a patient: its rarest positive class, num_class for no findings
+    class_frequencies = patient_labels.sum(axis=0)
+    stratums = np.where(patient_labels, class_frequencies, np.inf).argmin(axis=1)
+    stratums[~patient_labels.any(axis=1)] = num_class
 
-    valids = ori_trains[:int(total_row * VALID_RATIO)]
-    trains = ori_trains[int(total_row * VALID_RATIO):]
+    # fill valid_ratio of every stratum with the patients in a random order
+    patients = pd.DataFrame({"stratum": stratums, "size": patient_sizes}).iloc[rng.permutation(len(patient_sizes))]
+    filled = patients.groupby("stratum")["size"].cumsum() - patients["size"]
+    stratum_sizes = patients.groupby("stratum")["size"].transform("sum")
+    valid_patients = np.zeros(len(patient_sizes), dtype=bool)
+    valid_patients[patients.index.to_numpy()] = (filled < stratum_sizes * valid_ratio).to_numpy()
 
-    return (valids[:, 0], valids[:, 1:5].astype(float), valids[:, 5:].astype(float)), (
-        trains[:, 0], trains[:, 1:5].astype(float), trains[:, 5:].astype(float))
+    valid_rows = valid_patients[patient_codes]
+    return rng.permutation(np.flatnonzero(valid_rows)), rng.permutation(np.flatnonzero(~valid_rows))
 
 
-def calculate_K_SN(train_dataset):
-    sum_norm = 0.
-    n_mask = 0.
-    for img, _ in tqdm(train_dataset):
-        mask = tf.where(img > 0., 1., 0.)
-        norm_m = tf.reduce_sum(mask)
+def seperate_train_valid(paths, patient_datas, labels, total_row=None, valid_ratio=VALID_RATIO, seed=None):
+    """
+    Patient level, stratified train/valid split (see split_train_valid_indices), the columns keep their dtypes
+    :return: (valid paths, valid patient datas, valid labels), (train paths, train patient datas, train labels),
+        both ready for write_csv_to_tfrecord
+    """
+    paths, patient_datas, labels = np.asarray(paths), np.asarray(patient_datas, dtype=float), np.asarray(labels, dtype=float)
+    valid_indices, train_indices = split_train_valid_indices(paths, labels, valid_ratio, seed)
 
-        sum_norm += norm_m
-        n_mask += 1.
-    return sum_norm / (n_mask * BATCH_SIZE)
+    return (paths[valid_indices], patient_datas[valid_indices], labels[valid_indices]), (
+        paths[train_indices], patient_datas[train_indices], labels[train_indices])
 
 
-def load_image(img_path, use_preprocess_img=False):
+def _decode_jpeg_scaled(contents):
+    """
+    Decode a JPEG directly at 1/8, 1/4 or 1/2 scale in the DCT domain, the largest reduction that still is at least IMAGE_INPUT_SIZE
+    """
+    shape = tf.image.extract_jpeg_shape(contents)
+    min_side = tf.minimum(shape[0], shape[1])
+
+    def _decode(ratio):
+        return lambda: tf.image.decode_jpeg(contents, channels=1, ratio=ratio)
+
+    return tf.case([(min_side >= ratio * IMAGE_INPUT_SIZE, _decode(ratio)) for ratio in [8, 4, 2]],
+                   default=_decode(1), exclusive=False)
+
+
+def decode_image_contents(contents, use_dct_scaling=JPEG_DCT_SCALING):
+    """
+    Format-aware decoding of the file contents (JPEG or PNG), resized to IMAGE_INPUT_SIZE
+    :return: float32 image with pixel range 0~255
+    """
+    if not use_dct_scaling:
+        img = tf.image.decode_jpeg(contents, channels=1)  # decodes PNG too, at full resolution
+        return tf.image.resize(img, (IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE))
+
+    is_jpeg = tf.equal(tf.strings.substr(contents, 0, 3), b"\xff\xd8\xff")  # JPEG magic number
+
+    return tf.cond(is_jpeg,
+                   lambda: tf.image.resize(_decode_jpeg_scaled(contents), (IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE)),
+                   lambda: tf.image.resize(tf.image.decode_png(contents, channels=1), (IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE)))
+
+
+def decode_image(img_path, use_dct_scaling=JPEG_DCT_SCALING):
     # load image
     img = tf.io.read_file(img_path)
-    img = tf.image.decode_jpeg(img, channels=1)  # output rgb image
-    img = tf.image.resize(img, (IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE))
+    img = decode_image_contents(img, use_dct_scaling=use_dct_scaling)
+
+    return img
+
+
+def to_uint8(img):
+    if img.dtype == tf.uint8:
+        return img
+    return tf.cast(tf.round(tf.clip_by_value(img, 0., 255.)), tf.uint8)
+
+
+def preprocess_image(img, use_preprocess_img=False):
+    """
+    Normalize a resized image or a batch of images with pixel range 0~255 (float or uint8)
+    """
+    img = tf.cast(img, tf.float32)
 
     if use_preprocess_img:
         img = tf.keras.applications.xception.preprocess_input(img)
@@ -92,16 +177,36 @@ def load_image(img_path, use_preprocess_img=False):
         img /= 255.  # convert the range to 0~1
 
     # sparsity normalization
-    img = sparsity_norm(img) if USE_SPARSITY_NORM and K_SN != 1. else img
+    img = sparsity_norm(img, axis=[-3, -2, -1]) if USE_SPARSITY_NORM and K_SN != 1. else img
 
     return img
 
-def read_image_and_preprocess(filename, use_sn=False, use_preprocess_img=True):
+
+def load_image(img_path, use_preprocess_img=False):
+    return preprocess_image(decode_image(img_path), use_preprocess_img=use_preprocess_img)
+
+
+def check_in_model_preprocess(output_uint8, use_preprocess_img):
+    """
+    The models normalize the uint8 images with USE_PREPROCESS_IMG (see InputNormalization), the pipeline has to agree
+    """
+    assert not output_uint8 or use_preprocess_img == USE_PREPROCESS_IMG, \
+        "the models normalize the uint8 images with USE_PREPROCESS_IMG = %s" % USE_PREPROCESS_IMG
+
+
+def read_image_and_preprocess(filename, use_sn=False, use_preprocess_img=True, in_model_preprocess=USE_IN_MODEL_PREPROCESS):
+    """
+    :param in_model_preprocess: return the uint8 image for a model that normalizes it, only if use_preprocess_img is
+        its normalization (USE_PREPROCESS_IMG). Other normalizations are for display, not for such a model.
+    """
     img = skimage.io.imread(filename, True)
     img = skimage.transform.resize(img, (IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE))
 
     img *= 255.
 
+    if in_model_preprocess and use_preprocess_img == USE_PREPROCESS_IMG:  # the model normalizes the uint8 image itself, same as in training
+        return np.round(img).astype(np.uint8)
+
     if use_preprocess_img:
         img = tf.keras.applications.xception.preprocess_input(img)
     else:
@@ -139,40 +244,481 @@ def tf_serialize_example(f0, f1, f2):
     return tf.reshape(tf_string, ())  # The result is a scalar
 
 
-def write_csv_to_tfrecord(data, target_path):
+COMPRESSION_SUFFIX = {"GZIP": ".gz", "ZLIB": ".zlib"}
+
+
+def get_shard_filename(target_path, i_shard, compression_type=None):
+    return "%s-%05d%s" % (target_path, i_shard, COMPRESSION_SUFFIX.get(compression_type, ""))
+
+
+def get_shard_filenames(target_path):
+    return sorted(tf.io.gfile.glob(target_path + "-*"))
+
+
+def get_TFRecord_filenames(filename):
+    """
+    :return: [filename] if it is a single TFRecord, followed by the shards with filename as prefix (e.g. appended ones)
+    """
+    return ([filename] if tf.io.gfile.exists(filename) else []) + get_shard_filenames(filename)
+
+
+def get_compression_type(filename):
+    for compression_type, suffix in COMPRESSION_SUFFIX.items():
+        if filename.endswith(suffix):
+            return compression_type
+    return ""
+
+
+def read_TFRecord_files(filename, shuffle_files=False, num_shards=1, shard_index=0):
+    """
+    Read a single TFRecord or its shards, the shards are read with parallel interleave
+    :param num_shards: amount of training workers, every worker reads its own part of the records
+    :param shard_index: index of this worker
+    :return: dataset of serialized records
+    """
+    filenames = get_TFRecord_filenames(filename)
+    compression_type = get_compression_type(filenames[0])
+
+    if num_shards > 1:
+        if len(filenames) < num_shards:  # every worker keeps its records of the same unshuffled order
+            return read_TFRecord_files(filename).shard(num_shards, shard_index)
+        filenames = filenames[shard_index::num_shards]
+
+    if len(filenames) == 1:
+        return tf.data.TFRecordDataset(filenames, compression_type=compression_type)
+
+    files = tf.data.Dataset.from_tensor_slices(filenames)
+    files = files.shuffle(len(filenames)) if shuffle_files else files
+
+    return files.interleave(lambda f: tf.data.TFRecordDataset(f, compression_type=compression_type),
+                            cycle_length=min(len(filenames), TFRECORD_INTERLEAVE_CYCLE),
+                            num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+
+def _write_tfrecord_shard(args):
+    """
+    Worker of write_csv_to_tfrecord, runs in its own process
+    """
+    shard_path, compression_type, paths, patient_datas, labels = args
+
+    with tf.io.TFRecordWriter(shard_path, options=compression_type) as writer:
+        for path, patient_data, label in zip(paths, patient_datas, labels):
+            writer.write(serialize_example(path.encode() if isinstance(path, str) else path, patient_data, label))
+
+    return len(paths)
+
+
+def write_csv_to_tfrecord(data, target_path, num_shards=1, compression_type=TFRECORD_COMPRESSION, num_workers=None,
+                          append=False):
+    """
+    Write (paths, patient_datas, labels) to TFRecord. With num_shards > 1 the shards are named target_path-00000, ...
+    and written in parallel by a process pool.
+    :param compression_type: None, "GZIP" or "ZLIB"
+    :param num_workers: size of the process pool, default is the amount of cpus
+    :param append: add new shards after the existing TFRecord or shards instead of rewriting them
+    :return: the written filenames
+    """
     paths, patient_datas, labels = data
+    paths = [p.decode() if isinstance(p, bytes) else str(p) for p in paths]
+    patient_datas = np.asarray(patient_datas, dtype=np.float32)
+    labels = np.asarray(labels, dtype=np.float32)
+
+    get_and_mkdir(target_path)
+    shard_size = ceil(len(paths) / num_shards)
+    first_shard = len(get_shard_filenames(target_path)) if append else 0
+    shards = [(target_path if num_shards == 1 and compression_type is None and not append
+               else get_shard_filename(target_path, first_shard + i_shard, compression_type),
+               compression_type,
+               paths[i_shard * shard_size:(i_shard + 1) * shard_size],
+               patient_datas[i_shard * shard_size:(i_shard + 1) * shard_size],
+               labels[i_shard * shard_size:(i_shard + 1) * shard_size]) for i_shard in range(num_shards)]
+
+    print("Start writing to %s (%d shards)" % (target_path, num_shards))
+    if num_shards == 1:
+        _write_tfrecord_shard(shards[0])
+    else:
+        # spawn instead of fork, tensorflow is not fork safe
+        with multiprocessing.get_context("spawn").Pool(num_workers or os.cpu_count()) as pool:
+            for _ in tqdm(pool.imap_unordered(_write_tfrecord_shard, shards), total=num_shards):
+                pass
+    print("Writing successful")
+
+    return [shard[0] for shard in shards]
+
+
+def serialize_image_example(image_raw, patient_data, label):
+    """
+    Creates a tf.Example message holding the already resized uint8 image instead of the image path
+    """
+    feature = {
+        'image_raw': _bytes_feature(image_raw),
+        'patient_data': _float_feature(patient_data),
+        'label': _float_feature(label),
+    }
 
-    # create tf data Dataset
-    dataset = tf.data.Dataset.from_tensor_slices((paths, patient_datas, labels))
-    serialized_features_dataset = dataset.map(tf_serialize_example)
+    example_proto = tf.train.Example(features=tf.train.Features(feature=feature))
+    return example_proto.SerializeToString()
 
-    writer = tf.data.experimental.TFRecordWriter(target_path)
 
-    print("Start writing to %s" % target_path)
-    writer.write(serialized_features_dataset)
+def write_csv_to_image_shards(data, dataset_path, target_path, num_shards=IMAGE_SHARDS_N, compression_type=TFRECORD_COMPRESSION,
+                              append=False):
+    """
+    Decode and resize every image once and store the uint8 pixels in sharded TFRecords
+    :param data: (paths, patient_datas, labels)
+    :param dataset_path: root folder of the images
+    :param target_path: prefix of the shards, the shards are named target_path-00000, target_path-00001, ...
+    :param num_shards: amount of shards
+    :param append: number the new shards after the existing ones
+    :return: the written filenames
+    """
+    paths, patient_datas, labels = data
+    total_row = len(paths)
+
+    # decode the images in parallel, the order is preserved
+    images = tf.data.Dataset.from_tensor_slices(np.asarray(paths)).map(
+        lambda path: to_uint8(decode_image(tf.strings.join([dataset_path, '/', path]))),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE).prefetch(tf.data.experimental.AUTOTUNE)
+    images = iter(images)
+
+    get_and_mkdir(target_path)
+    shard_size = ceil(total_row / num_shards)
+    first_shard = len(get_shard_filenames(target_path)) if append else 0
+    shard_filenames = [get_shard_filename(target_path, first_shard + i_shard, compression_type) for i_shard in range(num_shards)]
+
+    print("Start writing to %s (%d shards)" % (target_path, num_shards))
+    for i_shard in tqdm(range(num_shards)):
+        with tf.io.TFRecordWriter(shard_filenames[i_shard], options=compression_type) as writer:
+            for i_row in range(i_shard * shard_size, min((i_shard + 1) * shard_size, total_row)):
+                writer.write(serialize_image_example(next(images).numpy().tobytes(), patient_datas[i_row], labels[i_row]))
     print("Writing successful")
 
+    return shard_filenames
 
-def read_TFRecord(filename, num_class=NUM_CLASSES):
-    filenames = [filename]
-    raw_dataset = tf.data.TFRecordDataset(filenames)
 
+def get_feature_description(num_class=NUM_CLASSES, decoded_image=False, labels_only=False):
     # Create a description of the features.
     feature_description = {
-        'image_path': tf.io.FixedLenFeature([], tf.string, default_value=''),
         'patient_data': tf.io.FixedLenFeature([4], tf.float32, default_value=[0] * 4),
         'label': tf.io.FixedLenFeature([num_class], tf.float32, default_value=[0] * num_class),
     }
+    if not labels_only:  # the image feature is not parsed at all for labels only
+        feature_description['image_raw' if decoded_image else 'image_path'] = tf.io.FixedLenFeature([], tf.string, default_value='')
+    return feature_description
+
+
+def filter_records(dataset, label_filter, num_class=NUM_CLASSES):
+    """
+    Keep the serialized records whose label satisfies label_filter, only the label is parsed
+    :param label_filter: function of a label tensor [num_class] returning a boolean scalar
+    """
+    label_description = get_feature_description(num_class, labels_only=True)
+    return dataset.filter(lambda serialized: label_filter(tf.io.parse_single_example(serialized, label_description)["label"]))
+
+
+def read_TFRecord(filename, num_class=NUM_CLASSES, shuffle_files=False, batch_size=None, labels_only=False):
+    """
+    :param batch_size: if given, the records are batched and parsed with one parse_example per batch
+    :param labels_only: only parse patient data and label
+    """
+    raw_dataset = read_TFRecord_files(filename, shuffle_files=shuffle_files)
+    feature_description = get_feature_description(num_class, labels_only=labels_only)
+
+    if batch_size:
+        return raw_dataset.batch(batch_size).map(lambda example_protos: tf.io.parse_example(example_protos, feature_description),
+                                                 num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
     def _parse_function(example_proto):
         # Parse the input `tf.Example` proto using the dictionary above.
         return tf.io.parse_single_example(example_proto, feature_description)
 
-    parsed_dataset = raw_dataset.map(_parse_function)
+    parsed_dataset = raw_dataset.map(_parse_function, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
     return parsed_dataset
 
 
+def get_memmap_cache_paths(cache_dir):
+    return {key: os.path.join(cache_dir, key + ".npy") for key in ["images", "patient_datas", "labels"]}
+
+
+def write_memmap_cache(filename, dataset_path, cache_dir, num_class=NUM_CLASSES):
+    """
+    Decode every image of a TFRecord once and store it in a memory-mapped uint8 array of shape (N, IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE)
+    Patient datas and labels are stored in side arrays with the same row order
+    :param filename: TFRecord of the split
+    :param dataset_path: root folder of the images
+    :param cache_dir: target folder, e.g. os.path.join(MEMMAP_DIR, "train")
+    """
+    cache_paths = get_memmap_cache_paths(cache_dir)
+
+    # the records are small, gather them first to know N
+    paths, patient_datas, labels = [], [], []
+    for data in read_TFRecord(filename, num_class, batch_size=4096):
+        paths.extend(data["image_path"].numpy())
+        patient_datas.append(data["patient_data"].numpy())
+        labels.append(data["label"].numpy())
+    total_row = len(paths)
+
+    get_and_mkdir(cache_paths["images"])
+    np.save(cache_paths["patient_datas"], np.concatenate(patient_datas).astype(np.float32))
+    np.save(cache_paths["labels"], np.concatenate(labels).astype(np.float32))
+
+    images = np.lib.format.open_memmap(cache_paths["images"], mode="w+", dtype=np.uint8,
+                                       shape=(total_row, IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE))
+
+    # decode the images in parallel, the order is preserved
+    decoded = tf.data.Dataset.from_tensor_slices(np.array(paths)).map(
+        lambda path: to_uint8(decode_image(tf.strings.join([dataset_path, '/', path])))[..., 0],
+        num_parallel_calls=tf.data.experimental.AUTOTUNE).batch(256).prefetch(tf.data.experimental.AUTOTUNE)
+
+    print("Start writing to %s" % cache_dir)
+    i_row = 0
+    for image_batch in tqdm(decoded, total=ceil(total_row / 256)):
+        images[i_row:i_row + len(image_batch)] = image_batch.numpy()
+        i_row += len(image_batch)
+    images.flush()
+    print("Writing successful")
+
+
+def read_memmap_cache(cache_dir):
+    """
+    :return: (images, patient datas, labels), the images are memory-mapped so several processes share the page cache
+    """
+    cache_paths = get_memmap_cache_paths(cache_dir)
+    return np.load(cache_paths["images"], mmap_mode="r"), np.load(cache_paths["patient_datas"]), np.load(cache_paths["labels"])
+
+
+def get_class_frequencies(class_frequencies, num_class, class_counts):
+    """
+    :param class_counts: amount of rows of every class + the rows without findings
+    :return: normalized target frequencies, classes without rows get 0
+    """
+    class_frequencies = np.ones(num_class + 1) if class_frequencies is None else np.asarray(class_frequencies, dtype=np.float64)
+    class_frequencies = np.where(np.asarray(class_counts) > 0, class_frequencies, 0.)
+    return class_frequencies / class_frequencies.sum()
+
+
+def balanced_row_sampler(labels, batch_size=BATCH_SIZE, class_frequencies=None, num_batches=None):
+    """
+    Batches of row indices drawn from per-class row lists: first a class with the target frequency, then a row of that class
+    :param labels: labels of every row
+    :param class_frequencies: target frequency of every class + one for the rows without findings, None is uniform
+    :param num_batches: amount of batches, None is infinite
+    """
+    labels = np.asarray(labels)
+    num_class = labels.shape[1]
+    class_row_ptr, class_rows = build_class_rows(labels)
+    no_finding_rows = np.flatnonzero((labels <= .5).all(axis=1))  # the last "class"
+
+    class_rows = np.concatenate([class_rows, no_finding_rows])
+    class_row_ptr = np.concatenate([class_row_ptr, [class_row_ptr[-1] + len(no_finding_rows)]])
+    class_counts = np.diff(class_row_ptr)
+
+    log_frequencies = tf.math.log(tf.constant(get_class_frequencies(class_frequencies, num_class, class_counts), tf.float32))
+    class_rows = tf.constant(class_rows, tf.int64)
+    class_row_ptr = tf.constant(class_row_ptr, tf.int64)
+
+    def _sample_rows(_):
+        i_classes = tf.random.categorical(log_frequencies[None], batch_size)[0]
+        starts = tf.gather(class_row_ptr, i_classes)
+        counts = tf.gather(class_row_ptr, i_classes + 1) - starts
+        offsets = tf.cast(tf.random.uniform([batch_size]) * tf.cast(counts, tf.float32), tf.int64)
+        return tf.gather(class_rows, starts + tf.minimum(offsets, counts - 1))
+
+    dataset = tf.data.experimental.Counter()
+    dataset = dataset.take(num_batches) if num_batches is not None else dataset
+    return dataset.map(_sample_rows)
+
+
+def count_TFRecord_records(filename):
+    return int(read_TFRecord_files(filename).reduce(np.int64(0), lambda n, _: n + 1))
+
+
+def get_metadata_index_split(filename):
+    """
+    :param filename: a TFRecord of the train, valid or test split of CheXpert or ChestX-ray14
+    :return: (metadata index path, split) of the rows of filename, see the split scripts in datasets/
+    """
+    for index_path, split_filenames in ((CHEXPERT_METADATA_INDEX_PATH, {"train": CHEXPERT_TRAIN_TARGET_TFRECORD_PATH,
+                                                                        "valid": CHEXPERT_VALID_TARGET_TFRECORD_PATH,
+                                                                        "test": CHEXPERT_TEST_TARGET_TFRECORD_PATH}),
+                                        (CHESTXRAY_METADATA_INDEX_PATH, {"train": CHESTXRAY_TRAIN_TARGET_TFRECORD_PATH,
+                                                                         "valid": CHESTXRAY_VALID_TARGET_TFRECORD_PATH,
+                                                                         "test": CHESTXRAY_TEST_TARGET_TFRECORD_PATH})):
+        for split, split_filename in split_filenames.items():
+            if os.path.abspath(filename) == os.path.abspath(split_filename):
+                return index_path, split
+
+    raise ValueError("no metadata index is known for %s, pass metadata_index_path and index_split" % filename)
+
+
+def read_class_balanced_rows(filename, index_path, split, batch_size=BATCH_SIZE, class_frequencies=None,
+                             label_filter=None, num_batches=None):
+    """
+    Batches of rows of a split of the metadata index drawn with balanced_row_sampler, the labels come from the index,
+    so no record is read to balance and only the images of the drawn rows are read
+    :param filename: the TFRecord the split stands in for, it must have as many records as the split has rows
+    :param label_filter: only draw the rows whose label satisfies it (see filter_records)
+    :param num_batches: amount of batches, None is infinite, -1 is an epoch of the (filtered) split
+    :return: dataset of batches of {"image_path", "patient_data", "label"}, like parse_example of the records
+    """
+    paths, patient_datas, labels = MetadataIndex.load(index_path).get_split(split)
+
+    num_records = count_TFRecord_records(filename)  # e.g. rows appended to the TFRecords but not to the index
+    if num_records != len(paths):
+        raise ValueError("the %s split of %s has %d rows but %s has %d records" % (split, index_path, len(paths),
+                                                                                  filename, num_records))
+
+    if label_filter is not None:  # only the labels in memory are filtered
+        keep = np.concatenate([keep.numpy() for keep in
+                               tf.data.Dataset.from_tensor_slices(labels).map(label_filter).batch(65536)])
+        paths, patient_datas, labels = paths[keep], patient_datas[keep], labels[keep]
+
+    num_batches = len(labels) // batch_size if num_batches == -1 else num_batches
+    dataset = balanced_row_sampler(labels, batch_size, class_frequencies, num_batches)
+
+    paths, patient_datas, labels = tf.constant(paths), tf.constant(patient_datas), tf.constant(labels)
+    return dataset.map(lambda rows: {"image_path": tf.gather(paths, rows), "patient_data": tf.gather(patient_datas, rows),
+                                     "label": tf.gather(labels, rows)})
+
+
+def read_memmap_dataset(cache_dir, shuffle=True, batch_size=BATCH_SIZE, repeat=False, drop_remainder=True, map_fn=None,
+                        class_balanced=False, class_frequencies=None, label_filter=None):
+    """
+    Serve batches of (uint8 image, patient data, label) from a memmap cache. Shuffling is a permutation of the row indices.
+    :param map_fn: optional function on (image, patient data, label) batches, fused into the gather map
+    :param class_balanced: draw the rows with balanced_row_sampler instead
+    :param label_filter: only serve the rows whose label satisfies it, evaluated once on the labels in memory
+    """
+    images, patient_datas, labels = read_memmap_cache(cache_dir)
+    rows = np.flatnonzero(tf.vectorized_map(label_filter, tf.constant(labels)).numpy()) \
+        if label_filter is not None else np.arange(len(images))
+    total_row = len(rows)
+    row_sampler = balanced_row_sampler(labels[rows], batch_size, class_frequencies,
+                                       num_batches=None if repeat else total_row // batch_size) if class_balanced else None
+    patient_datas = tf.constant(patient_datas)
+    labels = tf.constant(labels)
+
+    def _gather_images(indices):
+        return images[indices]
+
+    def _gather(indices):
+        indices = tf.sort(indices)  # sorted for sequential reads, the order inside a batch does not matter
+        image = tf.numpy_function(_gather_images, [indices], tf.uint8)
+        image = tf.reshape(image, (-1, IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE, 1))
+        batch = image, tf.gather(patient_datas, indices), tf.gather(labels, indices)
+        return map_fn(*batch) if map_fn is not None else batch
+
+    if row_sampler is not None:
+        subset_rows = tf.constant(rows, tf.int64)
+        dataset = row_sampler.map(lambda indices: tf.gather(subset_rows, indices))
+    else:
+        dataset = tf.data.Dataset.from_tensor_slices(rows.astype(np.int64))
+        dataset = dataset.shuffle(total_row) if shuffle else dataset  # a permutation of indices, reshuffled every epoch
+        dataset = dataset.repeat() if repeat else dataset
+        dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
+    dataset = dataset.map(_gather, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    return dataset
+
+
+def load_image_batch(data, dataset_path):
+    """
+    :param data: batch of parsed records, either with decoded images ("image_raw") or with paths ("image_path")
+    :param dataset_path: folder of the image paths, None if the paths are already full paths
+    :return: batch of images with pixel range 0~255, uint8 for decoded images and float32 for paths
+    """
+    if "image_raw" in data:
+        return tf.reshape(tf.io.decode_raw(data["image_raw"], tf.uint8), (-1, IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE, 1))
+
+    return tf.map_fn(lambda path: decode_image(path if dataset_path is None else tf.strings.join([dataset_path, '/', path])),
+                     data["image_path"],
+                     fn_output_signature=tf.TensorSpec((IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE, 1), tf.float32))
+
+
+def get_cache_filename(cache_dir, filename, dataset_path, num_class=NUM_CLASSES, use_decoded_shards=False,
+                       use_preprocess_img=True, output_uint8=False):
+    """
+    Cache file of the decoded, resized and normalized stream. The name is a hash of every preprocessing constant and of
+    the source records, so changing common_definitions invalidates the cache instead of reusing stale data.
+    """
+    sources = [(f, os.path.getsize(f), os.path.getmtime(f)) for f in get_TFRecord_filenames(filename)]
+    config = (IMAGE_INPUT_SIZE, use_preprocess_img, USE_SPARSITY_NORM, float(K_SN), JPEG_DCT_SCALING, output_uint8,
+              num_class, use_decoded_shards, dataset_path, sources)
+    key = hashlib.sha1(repr(config).encode()).hexdigest()[:16]
+
+    return os.path.join(cache_dir, "%s_%s" % (os.path.basename(filename), key))
+
+
+def distribute_dataset(dataset, data_service_address, processing_mode=DATA_SERVICE_PROCESSING_MODE, splittable=False):
+    """
+    Run the pipeline on the workers of a tf.data service instead of in this process
+    :param processing_mode: "distributed_epoch" splits the shards between the workers,
+        "parallel_epochs" lets every worker produce a whole epoch
+    :param splittable: the pipeline reads a single source of several TFRecord shards (see read_TFRecord_files),
+        "distributed_epoch" can only split the files of such a source
+    """
+    if processing_mode == "distributed_epoch" and not splittable:
+        raise ValueError("distributed_epoch needs a single source of several TFRecord shards, a single file or "
+                         "zipped, sampled or cached sources are produced by one worker, use parallel_epochs")
+
+    return dataset.apply(tf.data.experimental.service.distribute(processing_mode=processing_mode,
+                                                                 service=data_service_address))
+
+
+def echo_batches(dataset, echo_factor, shuffle_buffer=DATA_ECHO_SHUFFLE_BUFFER):
+    """
+    Data echoing: emit every batch echo_factor times, the echoes are shuffled among shuffle_buffer batches so they
+    do not follow each other
+    """
+    if echo_factor <= 1:
+        return dataset
+
+    dataset = dataset.flat_map(lambda *batch: tf.data.Dataset.from_tensors(batch).repeat(echo_factor))
+    return dataset.shuffle(shuffle_buffer) if shuffle_buffer > 1 else dataset
+
+
+def estimate_echo_factor(dataset, train_step, models=(), optimizers=(), metrics=(), num_batches=20,
+                         max_echo_factor=DATA_ECHO_MAX_FACTOR):
+    """
+    Echo factor from the measured ratio of the time the input pipeline needs for a batch to the time of a train step
+    :param dataset: the input pipeline without echoing
+    :param train_step: function of a batch, the measured steps are real train steps
+    :param models: the models the train step updates, their variables are restored afterwards
+    :param optimizers: their variables are restored too, the ones the steps created (e.g. Adam slots) are zeroed
+    :param metrics: the metrics the train step updates, they are reset afterwards
+    """
+    # the input time on a fresh iterator, its prefetch buffer was not filled while a step was traced
+    iterator = iter(dataset)
+    batch = next(iterator)  # start the pipeline, not measured
+    start_time = time.perf_counter()
+    for _ in range(num_batches):
+        batch = next(iterator)
+    input_time = (time.perf_counter() - start_time) / num_batches
+
+    # the steps apply their updates, snapshot the state first
+    variables = [variable for model in models for variable in model.variables]
+    variables += [variable for optimizer in optimizers for variable in optimizer.variables()]
+    snapshot = {variable.ref(): variable.read_value() for variable in variables}
+
+    train_step(batch)  # warm up and trace
+
+    start_time = time.perf_counter()
+    for _ in range(num_batches):
+        results = train_step(batch)
+    tf.nest.map_structure(lambda result: result.numpy() if hasattr(result, "numpy") else result, results)  # wait for the device
+    step_time = (time.perf_counter() - start_time) / num_batches
+
+    # restore the state
+    for variable in variables + [variable for optimizer in optimizers for variable in optimizer.variables()]:
+        variable.assign(snapshot[variable.ref()] if variable.ref() in snapshot else tf.zeros_like(variable))
+    for metric in metrics:
+        metric.reset_states()
+
+    echo_factor = int(np.clip(np.ceil(input_time / step_time), 1, max_echo_factor))
+    print("input %.1f ms, step %.1f ms per batch, echo factor %d" % (input_time * 1e3, step_time * 1e3, echo_factor))
+    return echo_factor
+
+
 def read_dataset(filename, dataset_path, use_augmentation=False, use_patient_data=False, image_only=True, num_class=14,
                  evaluation_mode=False,
                  eval_five_cats_index=EVAL_FIVE_CATS_INDEX,
@@ -184,60 +730,327 @@ def read_dataset(filename, dataset_path, use_augmentation=False, use_patient_dat
                  secondary_dataset_path=CHESTXRAY_DATASET_PATH,
                  use_preprocess_img=True,
                  repeat=False,
-                 drop_remainder=True):
-    dataset = read_TFRecord(filename, num_class)
-    dataset = dataset.map(lambda data: (
-        load_image(tf.strings.join([dataset_path, '/', data["image_path"]]), use_preprocess_img=use_preprocess_img), data["patient_data"],
-        data["label"]), num_parallel_calls=tf.data.experimental.AUTOTUNE)  # load the image
+                 drop_remainder=True,
+                 use_decoded_shards=False,
+                 memmap_dir=None,
+                 shuffle_files=True,
+                 output_uint8=USE_IN_MODEL_PREPROCESS,
+                 cache_dir=None,
+                 class_balanced=False,
+                 class_frequencies=CLASS_BALANCED_FREQUENCIES,
+                 metadata_index_path=None,
+                 index_split=None,
+                 labels_only=False,
+                 label_filter=None,
+                 echo_factor=1,
+                 data_service_address=None):
+    """
+    The records (paths or serialized images) are shuffled before the images are decoded, so the shuffle buffer
+    only holds small records instead of decoded float images. The records are then batched and every batch goes
+    through a single fused map: parse_example, decoding, augmentation, normalization, label gather and packing.
+    :param shuffle_files: if shuffle, also shuffle the order of the shards
+    :param output_uint8: yield uint8 images with pixel range 0~255, the model has to normalize them (USE_IN_MODEL_PREPROCESS)
+    :param cache_dir: materialize the decoded and normalized stream (before augmentation and shuffling) in this folder
+        on the first pass, later passes and runs read it back. Decoded images are shuffled with CACHE_SHUFFLE_BUFFER.
+    :param class_balanced: draw every sample by first drawing a class with class_frequencies (the last one is for rows
+        without findings), then a row of that class. Rows are picked from per-class row lists of the memmap cache
+        or of the index_split of the metadata index (instead of the TFRecords) before decoding. An epoch still has
+        the size of the dataset.
+    :param metadata_index_path: metadata index of the rows of filename for class_balanced, None derives it and
+        index_split from filename (see get_metadata_index_split)
+    :param labels_only: yield batches of (patient data, label) straight from the records, no image is read
+    :param label_filter: function of a single label (as yielded, e.g. the 5 categories in evaluation_mode) returning
+        a boolean scalar. Only the label of the records is parsed to filter them, so rejected images are never read.
+        With cache_dir the filter runs on the cached stream.
+    :param echo_factor: data echoing for input bound training, every decoded batch of the TFRecords is emitted
+        echo_factor times (see echo_batches) and every echo is augmented on its own. An epoch gets echo_factor times
+        as many batches. See estimate_echo_factor to pick it from the measured input and step times.
+    :param data_service_address: run the pipeline on the workers of this tf.data service (see datasets/data_service.py),
+        this process only receives the finished batches. DATA_SERVICE_PROCESSING_MODE applies to the sharded
+        TFRecords, the feature loss pipeline runs in "parallel_epochs".
+    """
+    check_in_model_preprocess(output_uint8, use_preprocess_img)
+    assert not (class_balanced and cache_dir is not None), "class balanced sampling can not read from the cache"
+    assert not (class_balanced and use_decoded_shards and memmap_dir is None), "the metadata index holds the image paths"
+    assert not (data_service_address and memmap_dir is not None), "the memmap cache is read in this process"
+    assert not (labels_only and use_feature_loss), "the feature loss needs the target images"
+    shuffle_files = shuffle and shuffle_files
+    _eval_five_cats_index = tf.constant(eval_five_cats_index)
+
+    normalized_range = 255. if output_uint8 else 2. if use_preprocess_img else 1.
+
+    def _normalize(image):
+        return to_uint8(image) if output_uint8 else preprocess_image(image, use_preprocess_img=use_preprocess_img)
+
+    def _pack(image, patient_data, label):
+        if not image_only:
+            return image, patient_data, label
+        elif use_patient_data:  # value 3.7 is chosen because there are 4 patient data
+            return {"input_img": image,
+                    "input_semantic": sparsity_norm(patient_data, k_sn=3.7, axis=-1) if USE_SPARSITY_NORM else patient_data}, label
+        else:  # if image only throw away patient data
+            return image, label
+
+    def _augment(image, value_range):
+        # augment the whole batch in graph, every sample gets its own random parameters
+        return batch_augment(image, value_range=value_range) if use_augmentation else image
+
+    def _gather_label(label):
+        return tf.gather(label, _eval_five_cats_index, axis=-1) if evaluation_mode and image_only else label
+
+    def _keep(label):
+        return label_filter(_gather_label(label))
+
+    def _process_batch(image, patient_data, label):
+        return _normalize(_augment(image, 255.)), patient_data, _gather_label(label)
+
+    def _parse_records(serialized, decoded_image=use_decoded_shards):
+        return tf.io.parse_example(serialized, get_feature_description(num_class, decoded_image=decoded_image))
+
+    def _process_records(data, _dataset_path):
+        return _process_batch(load_image_batch(data, _dataset_path), data["patient_data"], data["label"])
+
+    def _decode_records(data, _dataset_path):
+        return _normalize(load_image_batch(data, _dataset_path)), data["patient_data"], data["label"]
+
+    def _parse_labels(serialized):
+        data = tf.io.parse_example(serialized, get_feature_description(num_class, labels_only=True))
+        return data["patient_data"], _gather_label(data["label"])
+
+    def _fused(*batch):
+        return batch if use_feature_loss else _pack(*batch)  # feature loss batches are packed after the zip
+
+    def _process_decoded(image, patient_data, label):
+        return _fused(_augment(image, normalized_range), patient_data, _gather_label(label))
+
+    def _map_records(records, parse_fn=_parse_records):
+        """
+        :param parse_fn: features of a batch of records
+        """
+        if echo_factor <= 1:  # a single fused map per batch of records
+            return records.map(lambda batch: _fused(*_process_records(parse_fn(batch), dataset_path)),
+                               num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+        # decode once, then the echoes are augmented separately
+        dataset = records.map(lambda batch: _decode_records(parse_fn(batch), dataset_path),
+                              num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = echo_batches(dataset, echo_factor)
+        return dataset.map(_process_decoded, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    if labels_only:  # no image feature is parsed, read or decoded
+        dataset = read_TFRecord_files(filename, shuffle_files=shuffle_files)
+        dataset = filter_records(dataset, _keep, num_class) if label_filter is not None else dataset
+        dataset = dataset.repeat() if repeat else dataset
+        dataset = dataset.shuffle(buffer_size) if shuffle else dataset
+        dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
+        dataset = dataset.map(_parse_labels, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    elif memmap_dir is not None:  # serve from the memmap cache, shuffling and repeating are done on the row indices
+        dataset = read_memmap_dataset(memmap_dir, shuffle=shuffle, batch_size=batch_size, repeat=repeat,
+                                      drop_remainder=drop_remainder,
+                                      map_fn=lambda *batch: _fused(*_process_batch(*batch)),
+                                      class_balanced=class_balanced, class_frequencies=class_frequencies,
+                                      label_filter=_keep if label_filter is not None else None)
+    elif cache_dir is not None:  # decode and normalize once in the order of the records, then read back from the cache
+        cache_filename = get_cache_filename(cache_dir, filename, dataset_path, num_class, use_decoded_shards,
+                                            use_preprocess_img, output_uint8)
+        get_and_mkdir(cache_filename)
+
+        dataset = read_TFRecord_files(filename).batch(CACHE_BATCH_SIZE)
+        dataset = dataset.map(lambda serialized: _decode_records(_parse_records(serialized), dataset_path),
+                              num_parallel_calls=tf.data.experimental.AUTOTUNE).unbatch()
+        dataset = dataset.cache(cache_filename)
+        dataset = dataset.filter(lambda image, patient_data, label: _keep(label)) if label_filter is not None else dataset
+
+        dataset = dataset.repeat() if repeat else dataset
+        dataset = dataset.shuffle(min(buffer_size, CACHE_SHUFFLE_BUFFER)) if shuffle else dataset
+        dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
+        dataset = echo_batches(dataset, echo_factor)
+        dataset = dataset.map(_process_decoded, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    elif class_balanced:  # the rows are drawn from the metadata index, the batches are already parsed
+        if metadata_index_path is None:
+            metadata_index_path, index_split = get_metadata_index_split(filename)
+        dataset = read_class_balanced_rows(filename, metadata_index_path, index_split, batch_size, class_frequencies,
+                                           label_filter=_keep if label_filter is not None else None,
+                                           num_batches=None if repeat else -1)
+        dataset = _map_records(dataset, parse_fn=lambda data: data)
+    else:  # filename is a TFRecord or the prefix of its shards
+        dataset = read_TFRecord_files(filename, shuffle_files=shuffle_files)
+        dataset = filter_records(dataset, _keep, num_class) if label_filter is not None else dataset
+        dataset = dataset.repeat() if repeat else dataset
+        dataset = dataset.shuffle(buffer_size) if shuffle else dataset  # shuffle the records, not the decoded images
+        dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)  # batch with length of padding according to the the batch
+        dataset = _map_records(dataset)
 
-    if repeat:
-        dataset = dataset.repeat()
+    if use_feature_loss:
+        td_dataset = read_TFRecord_files(secondary_filename, shuffle_files=True).repeat().shuffle(buffer_size)  # shuffle before decoding
+        td_dataset = td_dataset.batch(batch_size, drop_remainder=True)
+        td_dataset = td_dataset.map(lambda serialized: _normalize(load_image_batch(
+            tf.io.parse_example(serialized, get_feature_description(num_class)), secondary_dataset_path)),
+                                    num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
-    if use_augmentation:
-        # Add augmentations
-        datagen = tf.keras.preprocessing.image.ImageDataGenerator(
-            rotation_range=5.,
-            shear_range=5.,
-            horizontal_flip=False,
-        )
+        dataset = tf.data.Dataset.zip((dataset, td_dataset))
 
-        dataset = dataset.map(lambda x, patient_data, label: (tf.reshape(tf.numpy_function(func=datagen.random_transform, inp=[x], Tout=[tf.float32])[0], (IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE, 1)), patient_data, label),
+        # source img, pat data, (source label, target img)
+        dataset = dataset.map(lambda ori_data, td_data: _pack(ori_data[0], ori_data[1],
+                                                              (ori_data[2], td_data[:tf.shape(ori_data[0])[0]])),
                               num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
-    if evaluation_mode:
-        dataset = dataset.map(lambda image, patient_data, label: (image, patient_data, tf.gather(label, tf.constant(eval_five_cats_index))),
-                              num_parallel_calls=tf.data.experimental.AUTOTUNE) if image_only else dataset  # if image only throw away patient data
+    if data_service_address:  # the zip with the target images can not be split between the service workers
+        splittable = not class_balanced and cache_dir is None and len(get_TFRecord_filenames(filename)) > 1
+        dataset = distribute_dataset(dataset, data_service_address,
+                                     "parallel_epochs" if use_feature_loss else DATA_SERVICE_PROCESSING_MODE, splittable)
 
+    # optimizer performance
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
-    if use_feature_loss:
-        td_dataset = read_TFRecord(secondary_filename, num_class).map(lambda data:
-            load_image(tf.strings.join([secondary_dataset_path, '/', data["image_path"]]), use_preprocess_img=use_preprocess_img),
-                                                                      num_parallel_calls=tf.data.experimental.AUTOTUNE)  # load the image
+    return dataset
 
-        td_dataset = td_dataset.repeat().shuffle(buffer_size)
 
-        dataset = tf.data.Dataset.zip((dataset, td_dataset))
+def read_dual_domain_dataset(source_filename, source_dataset_path, target_filename, target_dataset_path,
+                             target_ratio=DUAL_DOMAIN_TARGET_RATIO,
+                             use_augmentation=False,
+                             num_class=14,
+                             batch_size=BATCH_SIZE,
+                             buffer_size=BUFFER_SIZE,
+                             use_preprocess_img=True,
+                             use_decoded_shards=False,
+                             repeat=False,
+                             output_uint8=USE_IN_MODEL_PREPROCESS,
+                             echo_factor=1,
+                             data_service_address=None,
+                             num_shards=1,
+                             shard_index=0):
+    """
+    Aligned ((source image, source label), (target image, target label)) batches for the adversarial training from a
+    single pipeline. The shuffled record batches of both domains are zipped before decoding, then one fused map decodes
+    the images of both domains together, so they share the decode workers and the prefetch.
+    The source records define an epoch, the target records are repeated. Only the source images are augmented.
+    :param target_ratio: size of the target batch relative to batch_size, 0 yields empty target batches without
+        reading the target records
+    :param echo_factor: data echoing, see read_dataset
+    :param data_service_address: run the pipeline on the workers of this tf.data service in "parallel_epochs",
+        see read_dataset
+    :param num_shards: amount of training workers, the records of both domains are sharded before shuffling,
+        batch_size is then the batch of a single worker
+    :param shard_index: index of this worker
+    """
+    check_in_model_preprocess(output_uint8, use_preprocess_img)
+    target_batch_size = int(round(batch_size * target_ratio))
+    normalized_range = 255. if output_uint8 else 2. if use_preprocess_img else 1.
+    augment_before_echo = use_augmentation and echo_factor <= 1
+    feature_description = get_feature_description(num_class, decoded_image=use_decoded_shards)
+    image_key = "image_raw" if use_decoded_shards else "image_path"
+
+    def _read_records(filename, _batch_size, _repeat):
+        dataset = read_TFRecord_files(filename, shuffle_files=True, num_shards=num_shards, shard_index=shard_index)
+        dataset = dataset.repeat() if _repeat else dataset
+        dataset = dataset.shuffle(buffer_size)  # shuffle the records, not the decoded images
+        return dataset.batch(_batch_size, drop_remainder=True)
+
+    def _normalize(image):
+        return to_uint8(image) if output_uint8 else preprocess_image(image, use_preprocess_img=use_preprocess_img)
+
+    def _images(data, _dataset_path):
+        return data[image_key] if use_decoded_shards else tf.strings.join([_dataset_path, '/', data[image_key]])
+
+    def _process(source_serialized, target_serialized=None):
+        source = tf.io.parse_example(source_serialized, feature_description)
+        if target_serialized is None:
+            image = load_image_batch({image_key: _images(source, source_dataset_path)}, None)
+            target = (tf.zeros((0, IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE, 1), tf.uint8 if output_uint8 else tf.float32),
+                      tf.zeros((0, num_class)))
+        else:
+            target = tf.io.parse_example(target_serialized, feature_description)
+            image = load_image_batch({image_key: tf.concat([_images(source, source_dataset_path),
+                                                            _images(target, target_dataset_path)], axis=0)}, None)
+            target = (_normalize(image[batch_size:]), target["label"])
+
+        source_image = image[:batch_size]
+        source_image = batch_augment(source_image, value_range=255.) if augment_before_echo else source_image
+
+        return (_normalize(source_image), source["label"]), target
+
+    def _augment_echo(source, target):
+        return (batch_augment(source[0], value_range=normalized_range), source[1]), target
+
+    dataset = _read_records(source_filename, batch_size, repeat)
+    if target_batch_size:
+        dataset = tf.data.Dataset.zip((dataset, _read_records(target_filename, target_batch_size, True)))
+    dataset = dataset.map(_process, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = echo_batches(dataset, echo_factor)
+    if use_augmentation and not augment_before_echo:  # every echo is augmented on its own
+        dataset = dataset.map(_augment_echo, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    # the zipped domains can not be split between the service workers, every worker produces whole epochs
+    dataset = distribute_dataset(dataset, data_service_address, "parallel_epochs") if data_service_address else dataset
 
-        dataset = dataset.map(
-            lambda ori_data, td_data: (ori_data[0], ori_data[1],
-                                       (ori_data[2], td_data)),
-            num_parallel_calls=tf.data.experimental.AUTOTUNE)  # source img, pat data, (source label, target img)
-    else:
-        dataset = dataset.map(
-            lambda x, patient_data, label: (x, patient_data,
-                                            label),
-            num_parallel_calls=tf.data.experimental.AUTOTUNE)
-
-    if use_patient_data:
-        dataset = dataset.map(lambda image, patient_data, label: ({"input_img": image, "input_semantic":(sparsity_norm(patient_data, k_sn=3.7) if USE_SPARSITY_NORM else
-                                                                  patient_data)}, label),
-                              num_parallel_calls=tf.data.experimental.AUTOTUNE) if image_only else dataset  # if image only throw away patient data, value 3.7 is chosen because there are 4 patient data
-    else:
-        dataset = dataset.map(lambda image, _, label: (image, label),
-                              num_parallel_calls=tf.data.experimental.AUTOTUNE) if image_only else dataset  # if image only throw away patient data
+    # optimizer performance
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
-    dataset = dataset.shuffle(buffer_size) if shuffle else dataset
-    dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)  # shuffle and batch with length of padding according to the the batch
+    return dataset
+
+
+def read_multi_source_dataset(sources=((CHEXPERT_TRAIN_TARGET_TFRECORD_PATH, CHEXPERT_DATASET_PATH),
+                                       (CHESTXRAY_TRAIN_TARGET_TFRECORD_PATH, CHESTXRAY_DATASET_PATH)),
+                              weights=MULTI_SOURCE_WEIGHTS,
+                              label_indices=LABELS_COUPLE_INDEX,
+                              num_classes=None,
+                              use_augmentation=False,
+                              use_patient_data=False,
+                              shuffle=True,
+                              batch_size=BATCH_SIZE,
+                              buffer_size=BUFFER_SIZE,
+                              use_preprocess_img=True,
+                              use_decoded_shards=False,
+                              repeat=False,
+                              output_uint8=USE_IN_MODEL_PREPROCESS):
+    """
+    Batches sampled from any number of TFRecord sources with per-source weights, e.g. CheXpert and ChestX-ray14.
+    Every record is reduced to (image path or serialized image, patient data, label) and its label is gathered into
+    the shared label space of label_indices, then the records of all sources are mixed, shuffled and batched, and a
+    single fused map decodes the batch, so all sources share the same parallel decode workers.
+    Without repeat an epoch goes through every source once, the weights only set how the sources are interleaved.
+    :param sources: list of (filename, dataset_path), filename is a TFRecord or the prefix of its shards
+    :param weights: sampling weight of every source, None is uniform
+    :param label_indices: for every source the indices of its labels in the shared label space (LABELS_COUPLE_INDEX)
+    :param num_classes: amount of labels in the records of every source, None is NUM_CLASSES for all
+    """
+    check_in_model_preprocess(output_uint8, use_preprocess_img)
+    num_classes = num_classes or [NUM_CLASSES] * len(sources)
+    image_key = "image_raw" if use_decoded_shards else "image_path"
+
+    def _read_source(filename, dataset_path, num_class, label_index):
+        feature_description = get_feature_description(num_class, decoded_image=use_decoded_shards)
+        label_index = tf.constant(label_index)
+
+        def _harmonize(serialized):
+            data = tf.io.parse_single_example(serialized, feature_description)
+            image = data[image_key] if use_decoded_shards else tf.strings.join([dataset_path, '/', data[image_key]])
+            return image, data["patient_data"], tf.gather(data["label"], label_index)
+
+        dataset = read_TFRecord_files(filename, shuffle_files=shuffle)
+        dataset = dataset.repeat() if repeat else dataset
+        return dataset.map(_harmonize, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    def _normalize(image):
+        return to_uint8(image) if output_uint8 else preprocess_image(image, use_preprocess_img=use_preprocess_img)
+
+    def _process(image, patient_data, label):
+        image = load_image_batch({image_key: image}, None)
+        image = batch_augment(image, value_range=255.) if use_augmentation else image
+        image = _normalize(image)
+
+        if use_patient_data:  # value 3.7 is chosen because there are 4 patient data
+            return {"input_img": image,
+                    "input_semantic": sparsity_norm(patient_data, k_sn=3.7, axis=-1) if USE_SPARSITY_NORM else patient_data}, label
+        return image, label
+
+    datasets = [_read_source(filename, dataset_path, num_class, label_index)
+                for (filename, dataset_path), num_class, label_index in zip(sources, num_classes, label_indices)]
+    dataset = tf.data.experimental.sample_from_datasets(datasets, weights=weights)
+    dataset = dataset.shuffle(buffer_size) if shuffle else dataset  # shuffle the paths, not the decoded images
+    dataset = dataset.batch(batch_size, drop_remainder=True)
+    dataset = dataset.map(_process, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
     # optimizer performance
     dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
@@ -258,15 +1071,14 @@ def mapping(label):
 
 
 def read_dataset_multi_class(filename, dataset_path, image_only=True, num_class=14):
-    dataset = read_TFRecord(filename, num_class)
+    dataset = read_TFRecord(filename, num_class, shuffle_files=True).shuffle(BUFFER_SIZE)  # shuffle the paths before decoding
     dataset = dataset.map(lambda data: (
         load_image(tf.strings.join([dataset_path, '/', data["image_path"]])), data["patient_data"],
         mapping(data["label"])),
                           num_parallel_calls=tf.data.experimental.AUTOTUNE)  # load the image
     dataset = dataset.map(lambda image, _, label: (image, label),
                           num_parallel_calls=tf.data.experimental.AUTOTUNE) if image_only else dataset  # if image only throw away patient data
-    dataset = dataset.shuffle(BUFFER_SIZE).batch(
-        BATCH_SIZE)  # shuffle and batch with length of padding according to the the batch
+    dataset = dataset.batch(BATCH_SIZE)  # batch with length of padding according to the the batch
 
     return dataset
 
@@ -277,6 +1089,9 @@ if __name__ == "__main__":
     # for _train in train_dataset.take(1):
     #     print(_train)
 
+    # # joint CheXpert and ChestX-ray14 batches with the 7 shared labels
+    # joint_dataset = read_multi_source_dataset(use_augmentation=True, repeat=True)
+
     train_dataset = read_dataset(CHEXPERT_TRAIN_TARGET_TFRECORD_PATH, CHEXPERT_DATASET_PATH, use_augmentation=True, repeat=True)
 
     test_dataset = read_dataset(
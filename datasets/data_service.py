@@ -0,0 +1,81 @@
+"""
+tf.data service to run the input pipelines outside of the training process
+
+A dispatcher hands the pipelines of read_dataset(..., data_service_address=...) to its workers, which decode, augment
+and batch, the trainer only receives the finished batches. The workers need the TFRecords and images at the same
+paths, they can also run on other hosts:
+    python -m datasets.data_service dispatcher --port 5050
+    python -m datasets.data_service worker --dispatcher_address host:5050
+DATA_SERVICE_ADDRESS = "local" starts a dispatcher and DATA_SERVICE_WORKERS workers as local processes instead, in a
+multi-worker training only on the chief, the other training workers use the service of the chief.
+"""
+import argparse
+import multiprocessing
+from common_definitions import *
+from utils.utils import get_chief_address, is_chief_worker
+
+_local_service = None
+
+
+def run_dispatcher(port=DATA_SERVICE_PORT):
+    dispatcher = tf.data.experimental.service.DispatchServer(tf.data.experimental.service.DispatcherConfig(port=port))
+    print("Dispatcher is running on", dispatcher.target)
+    dispatcher.join()
+
+
+def run_worker(dispatcher_address, port=0):
+    """
+    :param dispatcher_address: host:port of the dispatcher
+    :param port: port of the worker, 0 picks a free one
+    """
+    worker = tf.data.experimental.service.WorkerServer(
+        tf.data.experimental.service.WorkerConfig(dispatcher_address=dispatcher_address, port=port))
+    print("Worker of %s is running" % dispatcher_address)
+    worker.join()
+
+
+def start_local_data_service(num_workers=DATA_SERVICE_WORKERS, port=DATA_SERVICE_PORT):
+    """
+    Start a dispatcher and its workers as separate processes on this host, they are stopped with this process
+    :return: address of the dispatcher
+    """
+    # spawn instead of fork, tensorflow is not fork safe
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=run_dispatcher, args=(port,), daemon=True)]
+    processes += [context.Process(target=run_worker, args=("localhost:%d" % port,), daemon=True) for _ in range(num_workers)]
+    for process in processes:
+        process.start()
+
+    return "grpc://localhost:%d" % port
+
+
+def get_data_service_address(data_service_address=DATA_SERVICE_ADDRESS):
+    """
+    :return: the address for read_dataset, "local" starts the local service once
+    """
+    global _local_service
+
+    if data_service_address != "local":
+        return data_service_address
+
+    # multi-worker training, a single service on the host of the chief
+    chief_address = get_chief_address()
+    if chief_address is not None and not is_chief_worker():
+        return "grpc://%s:%d" % (chief_address.split(":")[0], DATA_SERVICE_PORT)
+
+    if _local_service is None:
+        _local_service = start_local_data_service()
+    return _local_service
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="tf.data service dispatcher or worker")
+    parser.add_argument("role", choices=["dispatcher", "worker"])
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--dispatcher_address", default="localhost:%d" % DATA_SERVICE_PORT)
+    args = parser.parse_args()
+
+    if args.role == "dispatcher":
+        run_dispatcher(args.port or DATA_SERVICE_PORT)
+    else:
+        run_worker(args.dispatcher_address, args.port or 0)
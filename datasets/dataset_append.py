@@ -0,0 +1,62 @@
+"""
+Incremental append of new images to an existing dataset.
+
+Only the rows whose path is not yet in the metadata index are written, as new shards after the existing TFRecords.
+The metadata index (per-split counts, labels) and the statistics file are updated from the new rows only.
+"""
+from datasets.dataset_statistics import *
+from datasets.metadata_index import MetadataIndex
+
+
+def append_to_dataset(split, data, target_path, index_path, dataset_path, image_shards_path=None, statistics_path=None,
+                      num_shards=1):
+    """
+    :param split: name of the split in the metadata index, e.g. "train"
+    :param data: (paths, patient_datas, labels), may contain already ingested paths
+    :param target_path: the TFRecord or the prefix of its shards
+    :param index_path: the metadata index, it is created if it does not exist
+    :param image_shards_path: also append pre-decoded image shards (see write_csv_to_image_shards)
+    :param statistics_path: also update the statistics file, only for the split the statistics are computed on
+    :param num_shards: amount of new shards
+    :return: the index after appending
+
+    Usage:
+        >>> append_to_dataset("train", new_trains, TRAIN_TARGET_TFRECORD_PATH, METADATA_INDEX_PATH, DATASET_PATH,
+        ...                   statistics_path=DATASET_STATISTICS_PATH)
+
+    The memmap caches are not appended, rewrite them with write_memmap_cache.
+    """
+    index = MetadataIndex.load(index_path) if os.path.exists(index_path) else \
+        MetadataIndex([], np.zeros((0, 4)), np.zeros((0, np.shape(data[2])[1])), [])
+
+    # skip the already ingested paths with the hash set of the index
+    index, added = index.append({split: data})
+    new_data = added[split]
+    print("%d new rows of %d" % (len(new_data[0]), len(data[0])))
+    if not len(new_data[0]):
+        return index
+
+    # the new shards keep the compression of the existing ones
+    existing_filenames = get_TFRecord_filenames(target_path)
+    compression_type = (get_compression_type(existing_filenames[0]) or None) if existing_filenames else TFRECORD_COMPRESSION
+
+    num_shards = min(num_shards, len(new_data[0]))
+    new_filenames = write_csv_to_tfrecord(new_data, target_path, num_shards=num_shards, compression_type=compression_type,
+                                          append=True)
+    if image_shards_path is not None:
+        write_csv_to_image_shards(new_data, dataset_path, image_shards_path, num_shards=num_shards,
+                                  compression_type=compression_type, append=True)
+
+    if statistics_path is not None:
+        statistics = load_dataset_statistics(statistics_path)
+        statistics = update_dataset_statistics(statistics, new_filenames, dataset_path, num_class=np.shape(data[2])[1]) \
+            if statistics is not None else compute_dataset_statistics(target_path, dataset_path, num_class=np.shape(data[2])[1])
+        write_dataset_statistics(statistics, statistics_path)
+
+    index.save(index_path)
+
+    pos, neg = index.class_counts(split)
+    print("%s: %d rows, pos. per class = %s" % (split, len(index.split_rows(split)), pos.tolist()))
+
+    return index
+
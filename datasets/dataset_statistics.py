@@ -0,0 +1,114 @@
+"""
+Single-pass dataset statistics: per-class counts, balanced class weights, K_SN and pixel mean/std.
+The results are written to a versioned json file that common_definitions loads instead of the hardcoded numbers.
+"""
+import json
+from datasets.common import *
+from utils.utils import balanced_class_weights
+
+
+def compute_dataset_statistics(filename, dataset_path, num_class=NUM_CLASSES, use_decoded_shards=False, batch_size=256,
+                               dataset=DATASET_NAME):
+    """
+    Stream once over the dataset, the images are decoded and reduced per batch in parallel
+    :param dataset: name of the dataset, common_definitions only loads the statistics of DATASET_NAME
+    :return: dict of the statistics
+    """
+    totals = compute_totals(read_TFRecord_files(filename), dataset_path, num_class, use_decoded_shards, batch_size)
+    return statistics_from_totals(totals, source=filename, dataset=dataset)
+
+
+def update_dataset_statistics(statistics, filenames, dataset_path, num_class=NUM_CLASSES, use_decoded_shards=False,
+                              batch_size=256):
+    """
+    Add the records of new TFRecord files (e.g. appended shards) to existing statistics, only the new files are read
+    """
+    assert statistics["image_input_size"] == IMAGE_INPUT_SIZE, "the statistics were computed with another input size"
+
+    records = tf.data.TFRecordDataset(filenames, compression_type=get_compression_type(filenames[0]))
+    new_totals = compute_totals(records, dataset_path, num_class, use_decoded_shards, batch_size)
+    totals = {"n": statistics["n"], "pos": np.asarray(statistics["pos"]), **statistics["totals"]}
+
+    return statistics_from_totals({key: totals[key] + new_totals[key] for key in totals}, source=statistics["source"],
+                                  dataset=statistics["dataset"])
+
+
+def compute_totals(records, dataset_path, num_class=NUM_CLASSES, use_decoded_shards=False, batch_size=256):
+    """
+    :param records: dataset of serialized records
+    :return: dict of the summed n, pos, nonzero, pixel_sum and pixel_sq_sum
+    """
+
+    def _reduce_batch(serialized):
+        data = tf.io.parse_example(serialized, get_feature_description(num_class, decoded_image=use_decoded_shards))
+        image = tf.cast(load_image_batch(data, dataset_path), tf.float64)  # pixel range 0~255
+
+        return {"n": tf.shape(image, out_type=tf.int64)[0],
+                "pos": tf.reduce_sum(tf.cast(data["label"] > .5, tf.int64), axis=0),
+                "nonzero": tf.reduce_sum(tf.cast(image > 0., tf.int64)),  # for K_SN, see sparsity_norm
+                "pixel_sum": tf.reduce_sum(image),
+                "pixel_sq_sum": tf.reduce_sum(image ** 2)}
+
+    dataset = records.batch(batch_size)
+    dataset = dataset.map(_reduce_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE).prefetch(tf.data.experimental.AUTOTUNE)
+
+    totals = None
+    for batch in tqdm(dataset):
+        batch = {key: value.numpy() for key, value in batch.items()}
+        totals = batch if totals is None else {key: totals[key] + batch[key] for key in totals}
+
+    return totals
+
+
+def statistics_from_totals(totals, source="", dataset=DATASET_NAME):
+    """
+    :param totals: dict of the summed n, pos, nonzero, pixel_sum and pixel_sq_sum
+    """
+    n = int(totals["n"])
+    pos = np.asarray(totals["pos"], dtype=np.int64)
+    neg = n - pos
+    n_pixels = float(n) * IMAGE_INPUT_SIZE ** 2
+    pixel_mean = float(totals["pixel_sum"]) / n_pixels
+
+    return {"version": DATASET_STATISTICS_VERSION,
+            "dataset": dataset,
+            "source": source,
+            "image_input_size": IMAGE_INPUT_SIZE,
+            "n": n,
+            "pos": pos.tolist(),
+            "neg": neg.tolist(),
+            "class_weight": balanced_class_weights(pos, neg).tolist(),
+            "k_sn": float(totals["nonzero"]) / n,  # average amount of non zero pixels per image
+            "pixel_mean": pixel_mean,
+            "pixel_std": float(np.sqrt(max(float(totals["pixel_sq_sum"]) / n_pixels - pixel_mean ** 2, 0.))),
+            # raw sums, to update the statistics incrementally
+            "totals": {"nonzero": int(totals["nonzero"]),
+                       "pixel_sum": float(totals["pixel_sum"]),
+                       "pixel_sq_sum": float(totals["pixel_sq_sum"])}}
+
+
+def write_dataset_statistics(statistics, target_path=DATASET_STATISTICS_PATH):
+    get_and_mkdir(target_path)
+    with open(target_path, "w") as f:
+        json.dump(statistics, f, indent=2)
+
+
+def load_dataset_statistics(path=DATASET_STATISTICS_PATH):
+    """
+    :return: the statistics or None if the file is missing or has another version
+    """
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        statistics = json.load(f)
+    return statistics if statistics.get("version") == DATASET_STATISTICS_VERSION else None
+
+
+if __name__ == "__main__":
+    statistics = compute_dataset_statistics(TRAIN_TARGET_TFRECORD_PATH, DATASET_PATH)
+    write_dataset_statistics(statistics)
+
+    for i_class, label_key in enumerate(LABELS_KEY):
+        print("%s: pos. = %d ; neg. = %d" % (label_key, statistics["pos"][i_class], statistics["neg"][i_class]))
+    print("K_SN:", statistics["k_sn"], ", pixel mean:", statistics["pixel_mean"], ", pixel std:", statistics["pixel_std"])
@@ -0,0 +1,184 @@
+"""
+Persistent metadata index of a dataset keyed by image path.
+
+Columnar arrays (paths, patient datas, labels, split) plus a sorted table of path hashes are stored in one .npz,
+so labels, patient datas, splits and per-class rows are available without parsing the csv or scanning the TFRecords.
+"""
+import hashlib
+import numpy as np
+
+SPLITS = ["train", "valid", "test"]
+
+
+def hash_paths(paths):
+    """
+    64 bit hash of every path, stable across processes (unlike hash())
+    """
+    return np.array([int.from_bytes(hashlib.blake2b(p.encode() if isinstance(p, str) else bytes(p), digest_size=8).digest(), "little")
+                     for p in paths], dtype=np.uint64)
+
+
+def build_class_rows(labels):
+    """
+    Rows where each class is positive, in CSR layout
+    :return: (class_row_ptr, class_rows), the rows of class i are class_rows[class_row_ptr[i]:class_row_ptr[i + 1]]
+    """
+    labels = np.asarray(labels)
+    i_rows, i_classes = np.nonzero(labels > .5)
+    order = np.argsort(i_classes, kind="stable")
+    class_row_ptr = np.concatenate([[0], np.cumsum(np.bincount(i_classes, minlength=labels.shape[1]))])
+    return class_row_ptr, i_rows[order]
+
+
+class MetadataIndex:
+    """
+    Usage:
+        >>> index = MetadataIndex.build({"train": trains, "valid": valids, "test": tests})
+        >>> index.save(CHEXPERT_METADATA_INDEX_PATH)
+        >>> index = MetadataIndex.load(CHEXPERT_METADATA_INDEX_PATH)
+        >>> index.get_labels(["patient00001/study1/view1_frontal.jpg"])
+    """
+
+    def __init__(self, paths, patient_datas, labels, splits, split_names=SPLITS, path_hashes=None, hash_order=None,
+                 class_row_ptr=None, class_rows=None):
+        self.paths = np.asarray(paths).astype(str)
+        self.patient_datas = np.asarray(patient_datas, dtype=np.float32)
+        self.labels = np.asarray(labels, dtype=np.float32)
+        self.splits = np.asarray(splits, dtype=np.int8)
+        self.split_names = list(split_names)
+
+        # path -> row hash table, sorted hashes for vectorized lookups with searchsorted
+        if path_hashes is None:
+            path_hashes = hash_paths(self.paths)
+            hash_order = np.argsort(path_hashes, kind="stable")
+            path_hashes = path_hashes[hash_order]
+        self.path_hashes = path_hashes
+        self.hash_order = hash_order
+
+        # per-class positive rows in CSR layout
+        if class_row_ptr is None:
+            class_row_ptr, class_rows = build_class_rows(self.labels)
+        self.class_row_ptr = class_row_ptr
+        self.class_rows = class_rows
+
+    def __len__(self):
+        return len(self.paths)
+
+    @classmethod
+    def build(cls, splits_data):
+        """
+        :param splits_data: dict of split name -> (paths, patient_datas, labels)
+        """
+        split_names = list(splits_data.keys())
+        paths, patient_datas, labels, splits = [], [], [], []
+        for i_split, split_name in enumerate(split_names):
+            _paths, _patient_datas, _labels = splits_data[split_name]
+            paths.append(np.asarray(_paths).astype(str))
+            patient_datas.append(np.asarray(_patient_datas, dtype=np.float32))
+            labels.append(np.asarray(_labels, dtype=np.float32))
+            splits.append(np.full(len(_paths), i_split, dtype=np.int8))
+
+        return cls(np.concatenate(paths), np.concatenate(patient_datas), np.concatenate(labels), np.concatenate(splits),
+                   split_names=split_names)
+
+    def append(self, splits_data):
+        """
+        Add new rows, paths that are already in the index are skipped
+        :param splits_data: dict of split name -> (paths, patient_datas, labels)
+        :return: (the new index, dict of split name -> the rows of splits_data that were added)
+        """
+        paths, patient_datas, labels, splits = [self.paths], [self.patient_datas], [self.labels], [self.splits]
+        split_names = list(self.split_names)
+        added = {}
+        for split_name, (_paths, _patient_datas, _labels) in splits_data.items():
+            if split_name not in split_names:
+                split_names.append(split_name)
+
+            _paths = np.asarray(_paths).astype(str)
+            _, first_rows = np.unique(_paths, return_index=True)  # the first occurrence of duplicated paths
+            is_new = np.zeros(len(_paths), dtype=bool)
+            is_new[first_rows] = True
+            is_new &= ~self.contains(_paths)
+
+            added[split_name] = (_paths[is_new], np.asarray(_patient_datas, dtype=np.float32)[is_new],
+                                 np.asarray(_labels, dtype=np.float32)[is_new])
+            paths.append(added[split_name][0])
+            patient_datas.append(added[split_name][1])
+            labels.append(added[split_name][2])
+            splits.append(np.full(is_new.sum(), split_names.index(split_name), dtype=np.int8))
+
+        index = MetadataIndex(np.concatenate(paths), np.concatenate(patient_datas), np.concatenate(labels),
+                              np.concatenate(splits), split_names=split_names)
+        return index, added
+
+    def save(self, path):
+        np.savez(path, paths=self.paths, patient_datas=self.patient_datas, labels=self.labels, splits=self.splits,
+                 split_names=np.array(self.split_names), path_hashes=self.path_hashes, hash_order=self.hash_order,
+                 class_row_ptr=self.class_row_ptr, class_rows=self.class_rows)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["paths"], data["patient_datas"], data["labels"], data["splits"],
+                       split_names=data["split_names"].tolist(), path_hashes=data["path_hashes"],
+                       hash_order=data["hash_order"], class_row_ptr=data["class_row_ptr"],
+                       class_rows=data["class_rows"])
+
+    def _lookup_rows(self, paths):
+        """
+        :return: row of every path, -1 if the path is not in the index
+        """
+        paths = np.asarray(paths).astype(str)
+        if not len(self):
+            return np.full(len(paths), -1)
+
+        hashes = hash_paths(paths)
+        i_sorted = np.minimum(np.searchsorted(self.path_hashes, hashes), len(self) - 1)
+        rows = self.hash_order[i_sorted]
+
+        found = (self.path_hashes[i_sorted] == hashes) & (self.paths[rows] == paths)  # guard against hash collisions
+        return np.where(found, rows, -1)
+
+    def rows(self, paths):
+        """
+        :return: row of every path
+        :raise KeyError: if a path is not in the index
+        """
+        rows = self._lookup_rows(paths)
+        if (rows < 0).any():
+            raise KeyError("not in the index: %s" % np.asarray(paths).astype(str)[rows < 0].tolist())
+        return rows
+
+    def contains(self, paths):
+        return self._lookup_rows(paths) >= 0
+
+    def get_labels(self, paths):
+        return self.labels[self.rows(paths)]
+
+    def get_patient_datas(self, paths):
+        return self.patient_datas[self.rows(paths)]
+
+    def split_rows(self, split):
+        return np.flatnonzero(self.splits == self.split_names.index(split))
+
+    def get_split(self, split):
+        """
+        :return: (paths, patient_datas, labels) of the split in the written order
+        """
+        rows = self.split_rows(split)
+        return self.paths[rows], self.patient_datas[rows], self.labels[rows]
+
+    def class_rows_of(self, i_class, split=None):
+        """
+        :return: rows where class i_class is positive
+        """
+        rows = self.class_rows[self.class_row_ptr[i_class]:self.class_row_ptr[i_class + 1]]
+        return rows if split is None else rows[self.splits[rows] == self.split_names.index(split)]
+
+    def class_counts(self, split=None):
+        """
+        :return: (pos, neg) per class
+        """
+        labels = self.labels if split is None else self.labels[self.split_rows(split)]
+        pos = (labels > 0).sum(axis=0)
+        return pos, len(labels) - pos
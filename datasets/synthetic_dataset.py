@@ -0,0 +1,138 @@
+"""
+Synthetic chest X-ray like dataset
+
+Grayscale PNGs and TFRecords with the same schema as CheXpert and ChestX-ray14 (image_path, 4 patient datas,
+NUM_CLASSES labels), so the pipelines, trainings and evaluations can be benchmarked and tested without the licensed
+images. Every positive class draws an opacity at its own place, so the labels can be learned.
+Set USE_SYNTHETIC_DATASET in common_definitions to read it instead of both datasets.
+"""
+
+from datasets.dataset_statistics import *
+import skimage.draw
+import skimage.filters
+
+
+def generate_synthetic_image(label, rng, image_size=SYNTHETIC_IMAGE_SIZE):
+	"""
+	:param label: labels of the image, every positive class adds its opacity
+	:param rng: np.random.Generator
+	:return: uint8 image of image_size
+	"""
+	height, width = image_size
+	image = np.full(image_size, .15)
+
+	# thorax, lungs and heart
+	rr, cc = skimage.draw.ellipse(height * .55, width * .5, height * .45, width * .45, shape=image_size)
+	image[rr, cc] = .7
+	for side in [.3, .7]:
+		rr, cc = skimage.draw.ellipse(height * .5, width * side, height * .32, width * .17, shape=image_size)
+		image[rr, cc] = .3
+	rr, cc = skimage.draw.ellipse(height * .62, width * .55, height * .12, width * .13, shape=image_size)
+	image[rr, cc] = .75
+
+	# the opacity of every positive class, its place is fixed per class
+	for i_class in np.flatnonzero(np.asarray(label) > .5):
+		class_rng = np.random.default_rng(i_class)
+		center = class_rng.uniform([.25, .2], [.8, .8]) * image_size + rng.normal(0., .02, 2) * image_size
+		radius = class_rng.uniform(.04, .1) * min(image_size) * rng.uniform(.8, 1.2)
+		rr, cc = skimage.draw.disk(center, radius, shape=image_size)
+		image[rr, cc] += class_rng.uniform(.15, .3)
+
+	image = skimage.filters.gaussian(image, sigma=min(image_size) / 100.)
+	image += rng.normal(0., .03, image_size)
+
+	return (np.clip(image, 0., 1.) * 255.).astype(np.uint8)
+
+
+def _write_synthetic_images(args):
+	"""
+	Worker of generate_synthetic_dataset, runs in its own process
+	"""
+	dataset_path, indices, paths, labels, seed, image_size = args
+
+	for index, path, label in zip(indices, paths, labels):
+		image_path = os.path.join(dataset_path, path)
+		os.makedirs(os.path.dirname(image_path), exist_ok=True)
+		rng = np.random.default_rng([seed, index])  # the same image whatever the amount of workers
+		skimage.io.imsave(image_path, generate_synthetic_image(label, rng, image_size), check_contrast=False)
+
+	return len(paths)
+
+
+def generate_synthetic_dataset(n=SYNTHETIC_N, prevalence=SYNTHETIC_PREVALENCE, dataset_path=SYNTHETIC_DATASET_PATH,
+							   num_class=NUM_CLASSES, image_size=SYNTHETIC_IMAGE_SIZE, seed=0, num_workers=None):
+	"""
+	Draw the labels and patient datas and write the images, about 2 images per patient
+	:param prevalence: positive rate of every class, a float or a list of num_class floats
+	:return: (paths, patient_datas, labels), the paths are relative to dataset_path
+	"""
+	rng = np.random.default_rng(seed)
+
+	patient_ids = np.sort(rng.integers(0, max(n // 2, 1), n))
+	study_ids = np.arange(n) - np.searchsorted(patient_ids, patient_ids) + 1  # per patient 1, 2, ...
+	paths = np.array(["patient%05d/study%d/view1_frontal.png" % (patient_id, study_id)
+					  for patient_id, study_id in zip(patient_ids, study_ids)])
+
+	labels = (rng.random((n, num_class)) < np.broadcast_to(prevalence, (num_class,))).astype(float)
+
+	patient_datas = np.stack([
+		rng.choice([.5, 1.], n),  # sex
+		rng.uniform(.18, .9, n),  # age
+		rng.choice([.5, 1.], n, p=[.85, .15]),  # f/l
+		rng.choice([.5, 1.], n),  # ap/pa
+	], axis=1)
+
+	# write the images in parallel
+	num_chunks = min(os.cpu_count() * 4, n)
+	indices = np.arange(n)
+	chunks = [(dataset_path, indices[i::num_chunks], paths[i::num_chunks], labels[i::num_chunks], seed, image_size)
+			  for i in range(num_chunks)]
+
+	print("Start writing %d images to %s" % (n, dataset_path))
+	# spawn instead of fork, tensorflow is not fork safe
+	with multiprocessing.get_context("spawn").Pool(num_workers or os.cpu_count()) as pool:
+		for _ in tqdm(pool.imap_unordered(_write_synthetic_images, chunks), total=num_chunks):
+			pass
+	print("Writing successful")
+
+	return paths, patient_datas, labels
+
+
+def write_synthetic_dataset(n=SYNTHETIC_N, prevalence=SYNTHETIC_PREVALENCE, test_ratio=SYNTHETIC_TEST_RATIO, seed=0,
+							dataset_path=SYNTHETIC_DATASET_PATH,
+							train_target_tfrecord_path=SYNTHETIC_TRAIN_TARGET_TFRECORD_PATH,
+							valid_target_tfrecord_path=SYNTHETIC_VALID_TARGET_TFRECORD_PATH,
+							test_target_tfrecord_path=SYNTHETIC_TEST_TARGET_TFRECORD_PATH,
+							statistics_path=SYNTHETIC_STATISTICS_PATH):
+	"""
+	Generate the images and write the train, valid and test TFRecords, the splits are per patient.
+	The statistics of the train split are written with the amount of rows of every split, common_definitions reads
+	TRAIN_N, VAL_N and TEST_N from them.
+	:return: trains, valids, tests
+	"""
+	paths, patient_datas, labels = generate_synthetic_dataset(n, prevalence, dataset_path, seed=seed)
+
+	# the last patients are the test set
+	patient_ids = get_patient_ids(paths)
+	is_test = patient_ids >= np.sort(np.unique(patient_ids))[-max(int(len(np.unique(patient_ids)) * test_ratio), 1)]
+	tests = (paths[is_test], patient_datas[is_test], labels[is_test])
+	valids, trains = seperate_train_valid(paths[~is_test], patient_datas[~is_test], labels[~is_test], seed=seed)
+
+	write_csv_to_tfrecord(trains, train_target_tfrecord_path)
+	write_csv_to_tfrecord(valids, valid_target_tfrecord_path)
+	write_csv_to_tfrecord(tests, test_target_tfrecord_path)
+
+	statistics = compute_dataset_statistics(train_target_tfrecord_path, dataset_path, dataset="Synthetic")
+	statistics["split_n"] = {"train": len(trains[0]), "valid": len(valids[0]), "test": len(tests[0])}
+	write_dataset_statistics(statistics, statistics_path)
+
+	return trains, valids, tests
+
+
+if __name__ == "__main__":
+	trains, valids, tests = write_synthetic_dataset()
+	print("train: %d, valid: %d, test: %d" % (len(trains[0]), len(valids[0]), len(tests[0])))
+
+	train_dataset = read_dataset(SYNTHETIC_TRAIN_TARGET_TFRECORD_PATH, SYNTHETIC_DATASET_PATH)
+	for i in train_dataset.take(1):
+		print(i[0].shape, i[1].shape)
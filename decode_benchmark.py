@@ -0,0 +1,35 @@
+"""
+Benchmark decoding time per image of load_image, full resolution decoding vs format-aware DCT-domain downscaling
+"""
+import time
+from datasets.common import *
+
+NUM_IMAGES = 500
+
+
+def benchmark_decode(filename, dataset_path, use_dct_scaling, num_images=NUM_IMAGES):
+    """
+    :return: mean decoding time per image in ms
+    """
+    paths = next(iter(read_TFRecord(filename, batch_size=num_images)))["image_path"]
+    paths = tf.strings.join([dataset_path, '/', paths])
+
+    # read the files once so the page cache does not favour the second run
+    contents = [tf.io.read_file(path) for path in paths]
+
+    decode = tf.function(lambda content: decode_image_contents(content, use_dct_scaling=use_dct_scaling))
+    decode(contents[0])  # trace
+
+    start_time = time.time()
+    for content in contents:
+        decode(content)
+    return (time.time() - start_time) / len(contents) * 1000.
+
+
+if __name__ == "__main__":
+    for name, filename, dataset_path in [("CheXpert", CHEXPERT_TEST_TARGET_TFRECORD_PATH, CHEXPERT_DATASET_PATH),
+                                         ("ChestX-ray14", CHESTXRAY_VALID_TARGET_TFRECORD_PATH, CHESTXRAY_DATASET_PATH)]:
+        full_ms = benchmark_decode(filename, dataset_path, use_dct_scaling=False)
+        scaled_ms = benchmark_decode(filename, dataset_path, use_dct_scaling=True)
+        print("%s: full decode %.2f ms/image, format-aware decode %.2f ms/image (%.2fx)" %
+              (name, full_ms, scaled_ms, full_ms / scaled_ms))
@@ -35,7 +35,7 @@ if __name__ == "__main__":
 
 	# the data
 	_image = read_image_and_preprocess(target_filename, use_sn=False, use_preprocess_img=True)
-	image_ori = skimage.color.gray2rgb(read_image_and_preprocess(target_filename, use_sn=False, use_preprocess_img=False))
+	image_ori = skimage.color.gray2rgb(read_image_and_preprocess(target_filename, use_sn=False, use_preprocess_img=False, in_model_preprocess=False))  # 0~1
 
 	image = np.reshape(_image, (-1, IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE, 1))
 
@@ -30,9 +30,11 @@ if __name__ == "__main__":
         else:
             print("[Load weight] No weight is found")
 
+    # rows without any of the 5 categories are filtered before their image is read
     test_dataset = read_dataset(
         CHEXPERT_TEST_TARGET_TFRECORD_PATH if EVAL_CHEXPERT else CHESTXRAY_TEST_TARGET_TFRECORD_PATH,
-        CHEXPERT_DATASET_PATH if EVAL_CHEXPERT else CHESTXRAY_DATASET_PATH, evaluation_mode=True, use_patient_data=USE_PATIENT_DATA)
+        CHEXPERT_DATASET_PATH if EVAL_CHEXPERT else CHESTXRAY_DATASET_PATH, evaluation_mode=True, use_patient_data=USE_PATIENT_DATA,
+        label_filter=None if PRINT_PREDICTION else lambda label: tf.reduce_any(label > .5))
 
     _test_n = CHEXPERT_TEST_N  # TODO
 
@@ -45,7 +47,7 @@ if __name__ == "__main__":
         # feature_vectors = tf.reduce_mean(predictions[FEATURE_LAYER_NAME], axis=[1,2]).numpy()
         feature_vectors = predictions[FEATURE_LAYER_NAME].numpy()
 
-        # filter zeros
+        # filter zeros, only the predictions are left to filter here
         _i_zeros = np.argwhere(np.array(list(map(_np_to_binary, label))) != 0)[:, 0]
         label = label[_i_zeros]
         feature_vectors = feature_vectors[_i_zeros]
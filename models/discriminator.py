@@ -17,7 +17,8 @@ def make_discriminator_model():
 
     hidden = tf.keras.layers.Dropout(DROPOUT_N)(hidden)
 
-    output = tf.keras.layers.Dense(NUM_CLASSES, activation="sigmoid")(hidden)
+    output = tf.keras.layers.Dense(NUM_CLASSES)(hidden)
+    output = tf.keras.layers.Activation("sigmoid", dtype="float32")(output)  # float32 for the log based GAN losses
 
     return tf.keras.Model(inputs=[input_2, input_1], outputs=output)
 
@@ -30,7 +31,8 @@ def make_ADDA_discriminator_model():
 
     # hidden = tf.keras.layers.Dropout(DROPOUT_N)(hidden_1_act)
 
-    output = tf.keras.layers.Dense(NUM_CLASSES, activation="sigmoid")(hidden)
+    output = tf.keras.layers.Dense(NUM_CLASSES)(hidden)
+    output = tf.keras.layers.Activation("sigmoid", dtype="float32")(output)  # float32 for the log based GAN losses
 
     return tf.keras.Model(inputs=input_1, outputs=output)
 
@@ -3,6 +3,8 @@ Normal model with binary XE as loss function
 """
 from common_definitions import *
 from utils.weightnorm import WeightNormalization
+from models.preprocessing import InputNormalization
+from utils.xla import compile_step, count_retrace, get_batch_signature
 
 
 class EndBlock(tf.keras.layers.Layer):
@@ -25,9 +27,14 @@ class EndBlock(tf.keras.layers.Layer):
 
 
 class GANModel(tf.keras.Model):
-    def __init__(self):
+    def __init__(self, use_in_model_preprocess=USE_IN_MODEL_PREPROCESS, use_xla=USE_XLA_STEPS,
+                 use_preprocess_img=USE_PREPROCESS_IMG):
         super(GANModel, self).__init__()
 
+        # normalize the uint8 images of the input pipeline once per batch inside the graph
+        # use_preprocess_img has to be the one of the input pipeline
+        self.preprocess_layer = InputNormalization(use_preprocess_img, name="input_normalization") if use_in_model_preprocess else None
+
         self.input_layer = tf.keras.layers.Input(shape=(IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE, 1), name="input_img")
 
         image_section_model = tf.keras.applications.xception.Xception(include_top=False, weights=None, pooling=None,
@@ -44,22 +51,48 @@ class GANModel(tf.keras.Model):
         # post-process the image features
         self._bn = tf.keras.layers.BatchNormalization(
             name="block14_sepconv2_bn")  # the input can be from source or mixed
-        self._act = tf.keras.layers.Activation(LAST_ACTIVATION, name="block14_sepconv2_act")
+        # the features go to the discriminator and the feature losses, they are float32 with mixed precision
+        self._act = tf.keras.layers.Activation(LAST_ACTIVATION, name="block14_sepconv2_act", dtype="float32")
 
-        self.image_section_layer = tf.keras.layers.GlobalAveragePooling2D()
+        self.image_section_layer = tf.keras.layers.GlobalAveragePooling2D(dtype="float32")
 
         self.final_do = tf.keras.layers.Dropout(DROPOUT_N)
 
-        self.output_layer = tf.keras.layers.Dense(NUM_CLASSES, activation="sigmoid", kernel_initializer=KERNEL_INITIALIZER)
+        self.output_layer = tf.keras.layers.Dense(NUM_CLASSES, kernel_initializer=KERNEL_INITIALIZER)
 
         if USE_WN:
             self.output_layer = WeightNormalization(self.output_layer, data_init=False)
 
-    @tf.function
+        self.output_act = tf.keras.layers.Activation("sigmoid", dtype="float32", name="predictions")
+
+        # with XLA, one compiled call per training mode, the batch size is not part of the signature
+        image_spec = get_batch_signature(output_uint8=use_in_model_preprocess)[0]
+        self._image_dtype = image_spec.dtype
+        self._compiled_calls = [self._compile_call(image_spec, training) for training in [False, True]] if use_xla else None
+
+    def _compile_call(self, image_spec, training):
+        @compile_step([image_spec], use_xla=True)  # only called with use_xla of the constructor
+        def _call_w_features(inputs):
+            count_retrace("GANModel.call_w_features(training=%s)" % training)
+            return self.call_w_everything(inputs, training)[:2]
+
+        return _call_w_features
+
     def call_w_features(self, inputs, training=False, **kwargs):
+        if self._compiled_calls is not None:
+            # the dtype of the signature, the batches of the input pipeline are not cast
+            return self._compiled_calls[bool(training)](tf.cast(inputs, self._image_dtype))
+        return self._traced_call_w_features(inputs, training, **kwargs)
+
+    @tf.function
+    def _traced_call_w_features(self, inputs, training=False, **kwargs):
+        count_retrace("GANModel.call_w_features")
         return self.call_w_everything(inputs, training, **kwargs)[:2]
 
     def call_w_everything(self, inputs, training=False, **kwargs):
+        if self.preprocess_layer is not None:
+            inputs = self.preprocess_layer(inputs)
+
         shared_layer = self.shared_model(inputs, training)
 
         sep_conv1_act = self.sep_conv1_act(shared_layer, training)
@@ -73,12 +106,18 @@ class GANModel(tf.keras.Model):
 
         final_do = self.final_do(image_section_layer, training)
 
-        output_layer = self.output_layer(final_do)
+        output_layer = self.output_act(self.output_layer(final_do))
 
         return output_layer, image_section_layer, _act
 
-    @tf.function
     def call(self, inputs, training=False, **kwargs):
+        if self._compiled_calls is not None:
+            return self.call_w_features(inputs, training)[0]
+        return self._traced_call(inputs, training, **kwargs)
+
+    @tf.function
+    def _traced_call(self, inputs, training=False, **kwargs):
+        count_retrace("GANModel.call")
         return self.call_w_features(inputs, training, **kwargs)[0]
 
 
@@ -3,11 +3,18 @@ Normal model with binary XE as loss function
 """
 from common_definitions import *
 from utils.weightnorm import WeightNormalization
+from models.preprocessing import InputNormalization
 
-def raw_model_binaryXE(use_patient_data=False, use_wn=USE_WN):
-    input_layer = tf.keras.layers.Input(shape=(IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE, 1), name="input_img")
+def raw_model_binaryXE(use_patient_data=False, use_wn=USE_WN, use_in_model_preprocess=USE_IN_MODEL_PREPROCESS,
+                       use_preprocess_img=USE_PREPROCESS_IMG):
+    if use_in_model_preprocess:  # uint8 images, normalized once per batch inside the graph
+        input_layer = tf.keras.layers.Input(shape=(IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE, 1), name="input_img", dtype=tf.uint8)
+        input_img = InputNormalization(use_preprocess_img, name="input_normalization")(input_layer)  # the one of the input pipeline
+    else:
+        input_layer = tf.keras.layers.Input(shape=(IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE, 1), name="input_img")
+        input_img = input_layer
     image_section_model = tf.keras.applications.xception.Xception(include_top=False, weights=None, pooling=None,
-                                                                  input_tensor=input_layer)
+                                                                  input_tensor=input_img)
     image_feature_vectors = image_section_model.output
 
     # # add regularizer as the experiments show that it results positively when the avg value of image_feature_vectors is small
@@ -26,7 +33,7 @@ def raw_model_binaryXE(use_patient_data=False, use_wn=USE_WN):
     else:
         feature_vectors = image_feature_vectors
 
-    image_section_layer = tf.keras.layers.GlobalAveragePooling2D()(feature_vectors)
+    image_section_layer = tf.keras.layers.GlobalAveragePooling2D(dtype="float32")(feature_vectors)  # float32 features with mixed precision
 
     if USE_CONV1D:
         image_section_layer = tf.expand_dims(image_section_layer, -1)
@@ -0,0 +1,39 @@
+"""
+Input normalization inside the model, the input pipeline then only has to deliver uint8 images
+"""
+from common_definitions import *
+
+
+class InputNormalization(tf.keras.layers.Layer):
+    """
+    Cast a batch of images with pixel range 0~255 (uint8 or float) to float32 and apply the same normalization
+    as datasets.common.preprocess_image (Xception scaling or 0~1, optional sparsity normalization per image)
+    """
+
+    def __init__(self, use_preprocess_img=USE_PREPROCESS_IMG, use_sparsity_norm=USE_SPARSITY_NORM, k_sn=K_SN, **kwargs):
+        super().__init__(**kwargs)
+        self.use_preprocess_img = use_preprocess_img
+        self.use_sparsity_norm = use_sparsity_norm and k_sn != 1.
+        self.k_sn = k_sn
+
+    def call(self, inputs, **kwargs):
+        img = tf.cast(inputs, tf.float32)
+
+        if self.use_preprocess_img:
+            img = img / 127.5 - 1.  # same as xception.preprocess_input
+        else:
+            img = img / 255.  # convert the range to 0~1
+
+        # sparsity normalization, per image of the batch
+        if self.use_sparsity_norm:
+            norm_m = tf.reduce_sum(tf.where(img > 0., 1., 0.), axis=[1, 2, 3], keepdims=True)
+            img = self.k_sn * img / norm_m
+
+        return img
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({"use_preprocess_img": self.use_preprocess_img,
+                       "use_sparsity_norm": self.use_sparsity_norm,
+                       "k_sn": self.k_sn})
+        return config
@@ -0,0 +1,62 @@
+"""
+Launch a multi-worker data parallel training
+
+Every worker is a process of the training script with its own TF_CONFIG. The workers train the same models on their own
+shard of the records and all-reduce the gradients, see get_strategy in utils/utils.py.
+On this host, the workers run on the CPU unless --use_gpu:
+    python multi_worker_launcher.py binary_XE_train_CloGAN.py --num_workers 2
+On multiple hosts, run a single worker per host with the list of all the workers:
+    python multi_worker_launcher.py binary_XE_train_ADDA.py --workers host1:12345,host2:12345 --index 0
+"""
+import argparse
+import subprocess
+import sys
+from common_definitions import *
+
+
+def get_tf_config(workers, index):
+    return json.dumps({"cluster": {"worker": workers}, "task": {"type": "worker", "index": index}})
+
+
+def launch_workers(script, workers, indices, use_gpu=False, script_args=()):
+    """
+    :param workers: host:port of all the workers
+    :param indices: indices of the workers to start on this host
+    :return: exit codes of the started workers
+    """
+    processes = []
+    for index in indices:
+        env = dict(os.environ, TF_CONFIG=get_tf_config(workers, index))
+        if not use_gpu:
+            env["CUDA_VISIBLE_DEVICES"] = "-1"
+        processes.append(subprocess.Popen([sys.executable, script, *script_args], env=env))
+
+    try:
+        return [process.wait() for process in processes]
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        raise
+
+
+def launch_local_workers(script, num_workers=MULTI_WORKER_N, port=MULTI_WORKER_PORT, use_gpu=False, script_args=()):
+    workers = ["localhost:%d" % (port + i) for i in range(num_workers)]
+    return launch_workers(script, workers, range(num_workers), use_gpu, script_args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="multi-worker training of binary_XE_train_CloGAN.py or binary_XE_train_ADDA.py")
+    parser.add_argument("script")
+    parser.add_argument("--num_workers", type=int, default=MULTI_WORKER_N, help="amount of local workers")
+    parser.add_argument("--port", type=int, default=MULTI_WORKER_PORT, help="port of the first local worker")
+    parser.add_argument("--workers", default=None, help="host:port of all the workers, comma separated")
+    parser.add_argument("--index", type=int, default=0, help="index of this host in --workers")
+    parser.add_argument("--use_gpu", action="store_true")
+    args, script_args = parser.parse_known_args()
+
+    if args.workers:
+        exit_codes = launch_workers(args.script, args.workers.split(","), [args.index], args.use_gpu, script_args)
+    else:
+        exit_codes = launch_local_workers(args.script, args.num_workers, args.port, args.use_gpu, script_args)
+
+    sys.exit(max(exit_codes))
@@ -29,10 +29,8 @@ if __name__ == "__main__":
     # get the dataset
     if USE_TEST:
         _path = CHEXPERT_TEST_TARGET_TFRECORD_PATH if EVAL_CHEXPERT else CHESTXRAY_TEST_TARGET_TFRECORD_PATH
-        _test_n = CHEXPERT_TEST_N if EVAL_CHEXPERT else CHESTXRAY_TEST_N
     else:
         _path = CHEXPERT_VALID_TARGET_TFRECORD_PATH if EVAL_CHEXPERT else CHESTXRAY_VALID_TARGET_TFRECORD_PATH
-        _test_n = CHEXPERT_VAL_N if EVAL_CHEXPERT else CHESTXRAY_VAL_N
 
     _dataset_path = CHEXPERT_DATASET_PATH if EVAL_CHEXPERT else CHESTXRAY_DATASET_PATH
 
@@ -44,11 +42,12 @@ if __name__ == "__main__":
                                 drop_remainder=False,
                                 shuffle=False)
 
-    results = np.zeros((_test_n, 5), dtype=np.float32)
-    test_label_nps = np.zeros((_test_n, 5), dtype=np.float32)
+    # get the ground truth labels straight from the records, without reading the images
+    test_label_nps = np.concatenate([test_label.numpy() for _, test_label in read_dataset(
+        _path, _dataset_path, evaluation_mode=True, drop_remainder=False, shuffle=False, labels_only=True)])
+    results = np.zeros_like(test_label_nps)
 
-    # get the ground truth labels
-    for i_d, (test_img, test_label) in tqdm(enumerate(test_dataset.take(_test_n//BATCH_SIZE))):
+    for i_d, (test_img, _) in tqdm(enumerate(test_dataset)):
         _batch_to_fill = test_img.shape[0] if not USE_PATIENT_DATA else test_img["input_img"].shape[0]
 
         # Evaluate the model on the test data using `evaluate`
@@ -56,7 +55,6 @@ if __name__ == "__main__":
         result = result[:, TRAIN_FIVE_CATS_INDEX]
 
         results[i_d * BATCH_SIZE: i_d * BATCH_SIZE + _batch_to_fill] = result
-        test_label_nps[i_d * BATCH_SIZE: i_d * BATCH_SIZE + _batch_to_fill] = test_label
 
     # start calculating metrics
     print("F1: ", np.mean(f1(test_label_nps, results).numpy()))
@@ -2,6 +2,8 @@ from utils.kwd import *
 from utils.feature_loss import loss_2
 from utils.welford import Welford
 from datasets.cheXpert_dataset import read_dataset
+from datasets.common import get_metadata_index_split
+from datasets.metadata_index import MetadataIndex
 from models.multi_label import *
 from models.multi_class import model_MC_SVM
 from sklearn.decomposition import PCA
@@ -57,7 +59,12 @@ if __name__ == "__main__":
     mini = np.inf
     avg_feature = Welford()
 
-    _index_sd = tf.Variable(tf.zeros((TEST_N, 5)))
+    # the amount of test rows from the metadata index, without reading the records
+    _index_path, _split = get_metadata_index_split(
+        CHEXPERT_TEST_TARGET_TFRECORD_PATH if EVAL_CHEXPERT else CHESTXRAY_TEST_TARGET_TFRECORD_PATH)
+    _test_n = len(MetadataIndex.load(_index_path).split_rows(_split))
+
+    _index_sd = tf.Variable(tf.zeros((_test_n, 5)))
     featureStrength = FeatureMetric(num_classes=5, _indexs=_index_sd, _kalman_update_alpha=1)
 
     for i_d, (test_img, test_label) in tqdm(enumerate(test_dataset)):
@@ -51,21 +51,11 @@ def zoom(x: tf.Tensor) -> tf.Tensor:
         Augmented image
     """
 
-    # Generate 20 crop settings, ranging from a 1% to 20% crop.
-    scales = list(np.arange(0.8, 1.0, 0.01))
-    boxes = np.zeros((len(scales), 4))
-
-    for i, scale in enumerate(scales):
-        x1 = y1 = 0.5 - (0.5 * scale)
-        x2 = y2 = 0.5 + (0.5 * scale)
-        boxes[i] = [x1, y1, x2, y2]
-
     def random_crop(img):
-        # Create different crops for an image
-        crops = tf.image.crop_and_resize([img], boxes=boxes, box_indices=np.zeros(len(scales)), crop_size=(IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE))
-        # Return a random crop
-        return crops[tf.random.uniform(shape=[], minval=0, maxval=len(scales), dtype=tf.int32)]
-
+        # a single random crop ranging from a 1% to 20% crop
+        scale = tf.random.uniform(shape=[], minval=0.8, maxval=1.0)
+        box = tf.stack([0.5 - (0.5 * scale), 0.5 - (0.5 * scale), 0.5 + (0.5 * scale), 0.5 + (0.5 * scale)])
+        return tf.image.crop_and_resize([img], boxes=[box], box_indices=[0], crop_size=(IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE))[0]
 
     choice = tf.random.uniform(shape=[], minval=0., maxval=1., dtype=tf.float32)
 
@@ -86,6 +76,94 @@ def _gaussian_kernel(kernel_size, sigma, n_channels, dtype):
     g_kernel = tf.expand_dims(g_kernel, axis=-1)
     return tf.expand_dims(tf.tile(g_kernel, (1, 1, n_channels)), axis=-1)
 
-blur = _gaussian_kernel(3, tf.random.uniform([], 2, 10), 3, tf.float32)
 def apply_blur(img):
-    return tf.nn.depthwise_conv2d(img[None], blur, [1,1,1,1], 'SAME')[0]
\ No newline at end of file
+    blur = _gaussian_kernel(3, tf.random.uniform([], 2, 10), 3, tf.float32)  # new sigma on every call
+    return tf.nn.depthwise_conv2d(img[None], blur, [1,1,1,1], 'SAME')[0]
+
+
+def _affine_transforms(batch_size, height, width, rotation_range, shear_range, zoom_range, zoom_probability):
+    """Per sample projective transforms (rotation, shear, zoom around the center) for ImageProjectiveTransformV2
+
+    Returns:
+        Tensor [batch_size, 8] that maps output to input coordinates
+    """
+    theta = tf.random.uniform([batch_size], -rotation_range, rotation_range) * np.pi / 180.
+    shear = tf.random.uniform([batch_size], -shear_range, shear_range) * np.pi / 180.
+    scale = tf.random.uniform([batch_size], zoom_range[0], zoom_range[1])
+    scale = tf.where(tf.random.uniform([batch_size]) < zoom_probability, scale, tf.ones_like(scale))
+
+    zeros = tf.zeros_like(theta)
+    ones = tf.ones_like(theta)
+
+    def _matrices(*rows):  # [batch_size, 3, 3]
+        return tf.reshape(tf.stack(rows, axis=-1), (-1, 3, 3))
+
+    center_x, center_y = (tf.cast(width, tf.float32) - 1.) / 2., (tf.cast(height, tf.float32) - 1.) / 2.
+    to_origin = _matrices(ones, zeros, -center_x * ones, zeros, ones, -center_y * ones, zeros, zeros, ones)
+    from_origin = _matrices(ones, zeros, center_x * ones, zeros, ones, center_y * ones, zeros, zeros, ones)
+    rotation = _matrices(tf.cos(theta), -tf.sin(theta), zeros, tf.sin(theta), tf.cos(theta), zeros, zeros, zeros, ones)
+    shearing = _matrices(ones, -tf.sin(shear), zeros, zeros, tf.cos(shear), zeros, zeros, zeros, ones)
+    zooming = _matrices(scale, zeros, zeros, zeros, scale, zeros, zeros, zeros, ones)
+
+    transforms = from_origin @ rotation @ shearing @ zooming @ to_origin
+    return tf.reshape(transforms, (-1, 9))[:, :8]
+
+
+def _batch_gaussian_blur(x, sigma, kernel_size=5):
+    """Gaussian blur with its own sigma for every image of the batch, the batch is treated as channels of a depthwise conv
+    """
+    radius = kernel_size // 2
+    grid = tf.range(-radius, radius + 1, dtype=tf.float32)
+    g = tf.math.exp(-(grid[None, :] ** 2) / (2. * tf.maximum(sigma[:, None], 1e-3) ** 2))
+    g = g / tf.reduce_sum(g, axis=-1, keepdims=True)  # [batch, kernel_size]
+
+    x_t = tf.transpose(x, [3, 1, 2, 0])  # channels as batch, batch as channels
+    x_t = tf.nn.depthwise_conv2d(x_t, tf.transpose(g)[:, None, :, None], [1, 1, 1, 1], 'SAME')
+    x_t = tf.nn.depthwise_conv2d(x_t, tf.transpose(g)[None, :, :, None], [1, 1, 1, 1], 'SAME')
+    return tf.transpose(x_t, [3, 1, 2, 0])
+
+
+def batch_augment(x: tf.Tensor,
+                  value_range=1.,
+                  rotation_range=5.,
+                  shear_range=5.,
+                  zoom_range=(0.8, 1.0),
+                  zoom_probability=0.5,
+                  brightness=0.05,
+                  contrast_range=(0.8, 1.2),
+                  noise_stddev=0.05,
+                  blur_sigma_range=(0., 1.)) -> tf.Tensor:
+    """Graph-native augmentation of a whole batch with random parameters per sample
+
+    Args:
+        x: Batch of images [batch, height, width, channels], uint8 or float
+        value_range: max - min of the pixel values (255 for uint8, 2 for xception preprocessing, 1 for 0~1),
+            brightness and noise are relative to it
+
+    Returns:
+        Augmented batch with the dtype of x
+    """
+    dtype = x.dtype
+    x = tf.cast(x, tf.float32)
+    shape = tf.shape(x)
+    batch_size, height, width = shape[0], shape[1], shape[2]
+
+    # rotation, shear and zoom in a single resampling
+    transforms = _affine_transforms(batch_size, height, width, rotation_range, shear_range, zoom_range, zoom_probability)
+    x = tf.raw_ops.ImageProjectiveTransformV2(images=x, transforms=transforms, output_shape=shape[1:3],
+                                              interpolation="BILINEAR", fill_mode="NEAREST")
+
+    # brightness and contrast
+    mean = tf.reduce_mean(x, axis=[1, 2, 3], keepdims=True)
+    contrast = tf.random.uniform([batch_size, 1, 1, 1], contrast_range[0], contrast_range[1])
+    delta = tf.random.uniform([batch_size, 1, 1, 1], -brightness, brightness) * value_range
+    x = (x - mean) * contrast + mean + delta
+
+    # blur and noise
+    x = _batch_gaussian_blur(x, tf.random.uniform([batch_size], blur_sigma_range[0], blur_sigma_range[1]))
+    stddev = tf.random.uniform([batch_size, 1, 1, 1], 0., noise_stddev) * value_range
+    x = x + tf.random.normal(shape) * stddev
+
+    if dtype == tf.uint8:
+        return tf.cast(tf.round(tf.clip_by_value(x, 0., 255.)), tf.uint8)
+    return tf.cast(x, dtype)
\ No newline at end of file
@@ -197,6 +197,69 @@ class AUC_MC(tf.keras.metrics.AUC):
         super().update_state(y_true[-1, 1::2], y_pred[-1, 1::2], sample_weight)
 
 
+def get_optimizer(optimizer):
+    """
+    Wrap the optimizer with dynamic loss scaling if the global policy is mixed_float16, bfloat16 does not need it
+    """
+    if tf.keras.mixed_precision.global_policy().compute_dtype == "float16":
+        return tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+    return optimizer
+
+
+def get_scaled_loss(optimizer, loss):
+    return optimizer.get_scaled_loss(loss) if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer) else loss
+
+
+def get_unscaled_gradients(optimizer, gradients):
+    return optimizer.get_unscaled_gradients(gradients) if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer) else gradients
+
+
+def get_strategy():
+    """
+    MultiWorkerMirroredStrategy if TF_CONFIG describes a cluster (see multi_worker_launcher.py), otherwise the default
+    strategy which runs the same steps in this single process. Create it before any other op.
+    """
+    if "TF_CONFIG" in os.environ:
+        # ring all-reduce also runs on the CPU only workers
+        return tf.distribute.MultiWorkerMirroredStrategy(
+            communication_options=tf.distribute.experimental.CommunicationOptions(
+                implementation=tf.distribute.experimental.CommunicationImplementation.RING))
+    return tf.distribute.get_strategy()
+
+
+def is_chief_worker():
+    """
+    :return: whether this worker writes the checkpoints and logs, the first worker if the cluster has no chief
+    """
+    tf_config = json.loads(os.environ.get("TF_CONFIG", "{}"))
+    if "task" not in tf_config:
+        return True
+    if "chief" in tf_config.get("cluster", {}):
+        return tf_config["task"]["type"] == "chief"
+    return tf_config["task"]["type"] == "worker" and tf_config["task"]["index"] == 0
+
+
+def get_chief_address():
+    """
+    :return: host:port of the chief (or first worker) of the TF_CONFIG cluster, None without a cluster
+    """
+    cluster = json.loads(os.environ.get("TF_CONFIG", "{}")).get("cluster", {})
+    if not cluster:
+        return None
+    return cluster["chief"][0] if "chief" in cluster else cluster["worker"][0]
+
+
+def get_worker_cache_dir(cache_dir):
+    """
+    :return: a cache directory of its own for every worker of the TF_CONFIG cluster, tf.data caches can not be
+        filled by several workers at once
+    """
+    task = json.loads(os.environ.get("TF_CONFIG", "{}")).get("task")
+    if cache_dir is None or not task:
+        return cache_dir
+    return os.path.join(cache_dir, "%s%d" % (task["type"], task["index"]))
+
+
 def get_and_mkdir(path):
     dir_modelckp = os.path.dirname(path)
 
@@ -237,17 +300,26 @@ def get_max_acc_weight(path):
     return target_weight_file, max_epoch
 
 
-def calculating_class_weights(y_true):
-    number_dim = np.shape(y_true)[1]
-    weights = np.empty([number_dim, 2])
-    for i in tqdm(range(number_dim)):
-        try:
-            weights[i] = compute_class_weight('balanced', [0., 1.], y_true[:, i])
-        except ValueError:
-            weights[i] = np.ones(2)
+def balanced_class_weights(pos, neg):
+    """
+    Same as compute_class_weight('balanced', [0., 1.], y) for every class, ones if a class is missing
+    :return: array [num_class, 2] of (weight of negatives, weight of positives)
+    """
+    pos = np.asarray(pos, dtype=np.float64)
+    neg = np.asarray(neg, dtype=np.float64)
+    total = pos + neg
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weights = np.stack([total / (2. * neg), total / (2. * pos)], axis=1)
+    weights[(pos == 0) | (neg == 0)] = 1.  # compute_class_weight raises a ValueError
     return weights
 
 
+def calculating_class_weights(y_true):
+    y_true = np.asarray(y_true)
+    return balanced_class_weights((y_true == 1).sum(axis=0), (y_true == 0).sum(axis=0))
+
+
 def get_weighted_loss(weights):
     def weighted_loss(y_true, y_pred):
         return tf.keras.backend.mean(
@@ -0,0 +1,68 @@
+"""
+Opt-in XLA compilation of the train steps and model calls, and a counter of the tf.function traces
+
+The compiled functions have a fixed input signature with an unknown batch size, so the last smaller batch or a single
+image after the training does not trace them again. Without XLA (TensorFlow built without it or too old for
+jit_compile) they are still traced once with the same signature.
+"""
+from common_definitions import *
+
+_trace_counts = {}
+_xla_available = None
+
+
+def count_retrace(name):
+    """
+    Call it in the python body of a tf.function, it only runs while tracing
+    """
+    _trace_counts[name] = _trace_counts.get(name, 0) + 1
+    if _trace_counts[name] > 1:
+        print("[Retrace] %s is traced for the %d. time" % (name, _trace_counts[name]))
+
+
+def get_trace_counts():
+    return dict(_trace_counts)
+
+
+def get_num_retraces():
+    """
+    :return: amount of traces after the first one of every function, for the logs
+    """
+    return sum(count - 1 for count in _trace_counts.values())
+
+
+def is_xla_available():
+    global _xla_available
+
+    if _xla_available is None:
+        try:
+            tf.function(lambda x: x + 1., jit_compile=True)(tf.zeros([]))
+            _xla_available = True
+        except (TypeError, tf.errors.InvalidArgumentError, tf.errors.NotFoundError, tf.errors.UnimplementedError) as e:
+            print("[XLA] Not available, the steps are not compiled:", e)
+            _xla_available = False
+
+    return _xla_available
+
+
+def get_batch_signature(num_class=NUM_CLASSES, output_uint8=USE_IN_MODEL_PREPROCESS):
+    """
+    :return: specs of an (image batch, label batch) of the input pipelines
+    """
+    return (tf.TensorSpec((None, IMAGE_INPUT_SIZE, IMAGE_INPUT_SIZE, 1), tf.uint8 if output_uint8 else tf.float32),
+            tf.TensorSpec((None, num_class), tf.float32))
+
+
+def compile_step(input_signature=None, use_xla=USE_XLA_STEPS, jit_compile=True):
+    """
+    tf.function decorator of a train step or a model call
+    :param input_signature: only used with use_xla
+    :param use_xla: False is a plain tf.function
+    :param jit_compile: False only fixes the signature, e.g. for the collectives of a multi-worker step
+    """
+    if not use_xla:
+        return tf.function
+
+    if jit_compile and is_xla_available():
+        return tf.function(input_signature=input_signature, jit_compile=True)
+    return tf.function(input_signature=input_signature)